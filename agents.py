@@ -10,14 +10,34 @@ from system_prompts import (
     energy_market_data_collector, energy_market_analyst, energy_content_writer,
     generic_agent_prompt, project_manager
 )
-from openai import OpenAI
+from openaiclient import OPENAI_BASE_URL, model_timeout_seconds
+from modelregistry import completion_params
+from uservalidate import record_usage
 import os
 import streamlit as st
 
 # Set OpenAI API key as environment variable for crewAI
 os.environ["OPENAI_API_KEY"] = st.secrets["api_keys"]["openai"]
 OPENAI_API_KEY = st.secrets["api_keys"]["openai"]
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+
+def agent_llm(model, temperature, max_tokens):
+    """CrewAI LLM for a model picked in the UI: registry API name, output limit and reasoning quirks applied"""
+    return LLM(
+        **completion_params(model, max_tokens, temperature),
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        timeout=model_timeout_seconds(model)
+    )
+
+
+def record_crew_usage(username, model, crew_output):
+    """Record the tokens a crew run used, as reported in crew_output.token_usage"""
+    usage = getattr(crew_output, "token_usage", None)
+    if usage is None:
+        return 0.0
+    return record_usage(username, model, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                        cached_tokens=getattr(usage, "cached_prompt_tokens", 0) or 0)
 
 # Create a tool for webcrawling
 class WebCrawlerInput(BaseModel):
@@ -51,12 +71,7 @@ def software_development(query, model, temperature, max_tokens):
         role=str(coder_role),
         goal=str(coder_goal),
         backstory=str(coder_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         tools=[DirectoryReadTool()],
         allow_delegation = False,
         verbose= True,
@@ -80,12 +95,7 @@ def software_development(query, model, temperature, max_tokens):
         role=str(tester_role),
         goal=str(tester_goal),
         backstory=str(tester_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         tools=[DirectoryReadTool()],
         allow_delegation = False,
         verbose= True
@@ -118,12 +128,7 @@ def Nuclear_research(query, model, temperature, max_tokens):
         role=str(nuclear_scientist_role),
         goal=str(nuclear_scientist_goal),
         backstory=str(nuclear_scientist_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         allow_delegation = False,
         verbose= True
     )
@@ -139,12 +144,7 @@ def Nuclear_research(query, model, temperature, max_tokens):
         role=str(nuclear_agent_role),
         goal=str(nuclear_agent_goal),
         backstory=str(nuclear_agent_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         allow_delegation = False,
         verbose= True
     )
@@ -170,12 +170,7 @@ def Energy_market_research(query, model, temperature, max_tokens):
         role=str(energy_agent_role),
         goal=str(energy_agent_goal),
         backstory=str(energy_agent_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         allow_delegation = False,
         verbose= True,
         tools=[WebCrawlerTool()]
@@ -191,12 +186,7 @@ def Energy_market_research(query, model, temperature, max_tokens):
         role=str(energy_analyst_role),
         goal=str(energy_analyst_goal),
         backstory=str(energy_analyst_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         allow_delegation = False,
         verbose= True
     )
@@ -214,12 +204,7 @@ def Energy_market_research(query, model, temperature, max_tokens):
         role=str(energy_content_writer_role),
         goal=str(energy_content_writer_goal),
         backstory=str(energy_content_writer_backstory),
-        llm=LLM(
-            model = model,
-            temperature = temperature,
-            max_tokens=max_tokens,
-            api_key=OPENAI_API_KEY
-        ),
+        llm=agent_llm(model, temperature, max_tokens),
         allow_delegation = False,
         verbose= True
     )
@@ -276,12 +261,7 @@ def generic_agent_Setup(query, model, temperature, max_tokens, manager="Yes", ag
             role=str(agent_role),
             goal=str(agent_goal),
             backstory=str(agent_backstory),
-            llm=LLM(
-                model = model,
-                temperature = temperature,
-                max_tokens=max_tokens,
-                api_key=OPENAI_API_KEY
-            ),
+            llm=agent_llm(model, temperature, max_tokens),
             allow_delegation = False,
             verbose= True,
             max_iter=10,
@@ -1,7 +1,10 @@
 import time
 import streamlit as st
 import os
-from uservalidate import create_users_table, verify_user, add_user
+from uservalidate import (
+    create_users_table, verify_user, add_user,
+    LoginRateLimited, create_session, get_session_user, end_session
+)
 from styles import (
     get_main_styles, 
     get_welcome_styles
@@ -42,8 +45,14 @@ if __name__ == '__main__':
     if "authenticated" not in st.session_state:
         st.session_state["authenticated"] = False
 
+    # A rerun only checks the verified-session token; an expired token means a new login
+    if st.session_state.get("authenticated") and \
+            get_session_user(st.session_state.get("session_token")) != st.session_state.get("username"):
+        st.session_state["authenticated"] = False
+
     # Otherwise proceed with normal app flow
     if st.session_state.get("authenticated") and "logout" in st.query_params:
+        end_session(st.session_state.get("session_token"))
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.query_params.clear()
@@ -72,18 +81,24 @@ if __name__ == '__main__':
                 username = st.text_input("Username")
                 password = st.text_input("Password", type="password")
                 if st.button("Sign In"):
-                    if verify_user(username, password):
-                        st.session_state["authenticated"] = True
-                        st.session_state["username"] = username
-                        st.success("Logged in successfully!")
-                        time.sleep(1)
-                        st.rerun()
-                    elif username == "admin" and password == "mysecpwd":
+                    # The admin account is not in the users table: check it first, so its logins never count as failures
+                    if username == "admin" and password == "mysecpwd":
+                        verified = True
+                    else:
+                        try:
+                            verified = verify_user(username, password, ip=getattr(st.context, "ip_address", None))
+                        except LoginRateLimited as e:
+                            verified = None
+                            st.error(f"Too many failed attempts. Please try again in {e.retry_after} seconds.")
+                    if verified:
                         st.session_state["authenticated"] = True
                         st.session_state["username"] = username
+                        st.session_state["session_token"] = create_session(username)
                         st.success("Logged in successfully!")
                         time.sleep(1)
                         st.rerun()
+                    elif verified is None:
+                        pass
                     else:
                         st.error("Invalid username or password")
         elif st.session_state.get("page") == "Sign Up":
@@ -1,5 +1,8 @@
-import os, re, json, shutil, uuid
+import os, re, shutil, time, uuid
 import streamlit as st
+import chatstore
+from vectordb import get_temp_store, close_vector_store
+from ingestjobs import cancel_chat_jobs
 
 # Add username sanitization function
 def sanitize_username(username: str) -> str:
@@ -20,55 +23,56 @@ def get_chat_history_filename(username: str) -> str:
     chat_dir = ensure_chat_history_dir()
     return os.path.join(chat_dir, f"{sanitized}_chat_history.json")
 
-# Save the chat sessions to the chat history file
-def save_chat_sessions(sessions, username: str):
-    filename = get_chat_history_filename(username)
-    ensure_chat_history_dir()  # Make sure directory exists
-    with open(filename, "w") as f:
-        try:
-            json.dump(sessions, f, default=str)  # Use default=str to handle non-serializable objects
-        except TypeError as e:
-            print(f"Error saving chat sessions: {e}")
-
-# Load the chat sessions from chat history file
+# Load the chat sessions from the chat history store (messages are loaded when a chat is opened)
 def load_chat_sessions(username: str) -> list:
-    filename = get_chat_history_filename(username)
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return []
-    # Check for files in old location for backward compatibility
-    old_filename = f"{sanitize_username(username)}_chat_history.json"
-    if os.path.exists(old_filename):
-        with open(old_filename, "r") as f:
-            try:
-                data = json.load(f)
-                # Save to new location for future use
-                save_chat_sessions(data, username)
-                return data
-            except json.JSONDecodeError:
-                return []
-    return []
+    if not chatstore.has_chats(username):
+        # Import a legacy JSON history once, from the current or the old location
+        for filename in (get_chat_history_filename(username), f"{sanitize_username(username)}_chat_history.json"):
+            if os.path.exists(filename) and chatstore.migrate_json_history(username, filename):
+                break
+    return chatstore.load_chats(username)
+
+# Read the messages of a chat from the store the first time it is opened
+def load_chat_messages(chat: dict) -> list:
+    if not chat.get("messages_loaded", True):
+        chat["messages"] = chatstore.load_messages(chat["chat_id"])
+        chat["messages_loaded"] = True
+    return chat["messages"]
+
+# Full-text search over all chats of a user: dicts with chat_id, position, title and snippet, best first
+def search_chat_history(query: str, username: str, limit: int = 20) -> list:
+    return chatstore.search_messages(username, query, limit)
+
+# Append one message to a chat and write only that message
+def save_chat_message(chat: dict, question: str, answer: str, username: str):
+    load_chat_messages(chat)
+    chat["messages"].append({"question": question, "answer": answer})
+    chat["updated_at"] = time.time()
+    chatstore.append_message(username, chat, len(chat["messages"]) - 1, question, answer)
 
 # Append a new message to the current chat session
 def append_message_to_current_chat(question: str, answer: str):
+    if "username" not in st.session_state:
+        st.error("User not logged in!")
+        return
     for chat in st.session_state.chat_sessions:
         if chat["chat_id"] == st.session_state.current_chat_id:
-            if not chat['messages']:
+            if not load_chat_messages(chat):
                 chat["title"] = chat_title(question)
-            chat["messages"].append({"question": question, "answer": answer})
+            save_chat_message(chat, question, answer, st.session_state.username)
             break
-    if "username" in st.session_state:
-        save_chat_sessions(st.session_state.chat_sessions, st.session_state.username)
-    else:
-        st.error("User not logged in!")
+
+# Favorite and other chats, most recently active first
+def sidebar_chat_index(sessions: list) -> tuple[list, list]:
+    ordered = sorted(sessions, key=lambda chat: chat.get("updated_at", 0), reverse=True)
+    favorites = [chat for chat in ordered if chat.get("favorite", False)]
+    old_chats = [chat for chat in ordered if not chat.get("favorite", False)]
+    return favorites, old_chats
 
 # Define a chat title based on first prompt question
 def chat_title(first_prompt, max_length=50):
     if len(first_prompt) <= max_length:
-        return first_prompt.text.strip()
+        return first_prompt.strip()
     truncated = first_prompt[:max_length]
     last_space_index = truncated.rfind(" ")
     if last_space_index == -1:
@@ -78,37 +82,40 @@ def chat_title(first_prompt, max_length=50):
 def delete_chat(chat_id):
     username = st.session_state.get("username")
     if username != "admin":
-        temp_store_path = f"rag_chroma_temp_user_{username}_{chat_id}"
+        # Background ingestion into the chat's store must stop before the store is removed
+        if not cancel_chat_jobs(username, chat_id):
+            st.error("Files are still being indexed into this chat, please try deleting it again in a moment.")
+            return
+        temp_store_path, _ = get_temp_store(username, chat_id)
+        # Release the pooled client before the store is removed from disk
+        close_vector_store(temp_store_path)
         if os.path.exists(temp_store_path):
             shutil.rmtree(temp_store_path)
+    chatstore.delete_chat(chat_id)
     st.session_state.chat_sessions = [
         c for c in st.session_state.chat_sessions if c["chat_id"] != chat_id
     ]
     if st.session_state.chat_sessions:
         st.session_state.current_chat_id = st.session_state.chat_sessions[0]["chat_id"]
     else:
-        new_chat_id = str(uuid.uuid4())
-        st.session_state.current_chat_id = new_chat_id
-        st.session_state.chat_sessions.append({
-            "chat_id": new_chat_id,
-            "title": "New Chat",
-            "messages": [],
-            "favorite": False
-        })
-    save_chat_sessions(st.session_state.chat_sessions, username)
+        new_chat_id()
     st.success("Chat deleted successfully!")
     st.rerun()
 
 def new_chat_id():
     """
-        Generates a new chat ID and adds it to the session state. Returns the new chat ID.
+        Generates a new chat ID, adds it to the session state and stores it. Returns the new chat ID.
     """
     new_id = str(uuid.uuid4())
     st.session_state.current_chat_id = new_id
-    st.session_state.chat_sessions.append({
+    chat = {
         "chat_id": new_id,
         "title": "New Chat",
         "messages": [],
-        "favorite": False
-    })
+        "favorite": False,
+        "updated_at": time.time()
+    }
+    st.session_state.chat_sessions.append(chat)
+    if "username" in st.session_state:
+        chatstore.save_chat(st.session_state.username, chat)
     return new_id
@@ -0,0 +1,175 @@
+import json, os, time
+from dbconnection import get_connection
+
+# Chat history lives in one SQLite database: one row per chat, one row per message.
+# Writes touch only the changed rows, and messages are read only when a chat is opened.
+CHAT_DB_PATH = os.path.join("userchathistory", "chat_history.db")
+SEARCH_SNIPPET_TOKENS = 12
+
+
+def _setup(conn):
+    index_exists = conn.execute(
+        "select 1 from sqlite_master where type = 'table' and name = 'messages_fts'"
+    ).fetchone() is not None
+    conn.executescript("""
+        create table if not exists chats (
+            chat_id text primary key,
+            username text not null,
+            title text not null,
+            favorite integer not null default 0,
+            created_at real not null,
+            updated_at real not null);
+        create index if not exists chats_by_user on chats (username, created_at);
+        create table if not exists messages (
+            chat_id text not null,
+            position integer not null,
+            question text not null,
+            answer text not null,
+            created_at real not null,
+            primary key (chat_id, position));
+        -- Full-text index over questions and answers, kept in step with messages by triggers
+        create virtual table if not exists messages_fts using fts5(
+            question, answer, content='messages', content_rowid='rowid');
+        create trigger if not exists messages_fts_insert after insert on messages begin
+            insert into messages_fts (rowid, question, answer) values (new.rowid, new.question, new.answer);
+        end;
+        create trigger if not exists messages_fts_delete after delete on messages begin
+            insert into messages_fts (messages_fts, rowid, question, answer)
+            values ('delete', old.rowid, old.question, old.answer);
+        end;
+        create trigger if not exists messages_fts_update after update on messages begin
+            insert into messages_fts (messages_fts, rowid, question, answer)
+            values ('delete', old.rowid, old.question, old.answer);
+            insert into messages_fts (rowid, question, answer) values (new.rowid, new.question, new.answer);
+        end;
+    """)
+    if not index_exists:
+        # Index messages stored before the search index existed
+        with conn:
+            conn.execute("insert into messages_fts (messages_fts) values ('rebuild')")
+
+
+def _connect():
+    """A pooled connection to the chat history database, for use in a with block"""
+    return get_connection(CHAT_DB_PATH, _setup)
+
+
+def has_chats(username: str) -> bool:
+    with _connect() as conn:
+        return conn.execute("select 1 from chats where username = ? limit 1", (username,)).fetchone() is not None
+
+
+def load_chats(username: str) -> list[dict]:
+    """Chats of a user in creation order, without their messages"""
+    with _connect() as conn:
+        rows = conn.execute(
+            "select chat_id, title, favorite, updated_at from chats where username = ? order by created_at, rowid", (username,)
+        ).fetchall()
+    return [{"chat_id": row["chat_id"], "title": row["title"], "messages": [], "favorite": bool(row["favorite"]),
+             "updated_at": row["updated_at"], "messages_loaded": False} for row in rows]
+
+
+def load_messages(chat_id: str) -> list[dict]:
+    with _connect() as conn:
+        rows = conn.execute(
+            "select question, answer from messages where chat_id = ? order by position", (chat_id,)
+        ).fetchall()
+    return [{"question": row["question"], "answer": row["answer"]} for row in rows]
+
+
+def save_chat(username: str, chat: dict):
+    """Insert a chat or update its title and favorite flag (without counting as activity)"""
+    now = time.time()
+    with _connect() as conn, conn:
+        conn.execute(
+            """insert into chats (chat_id, username, title, favorite, created_at, updated_at) values (?, ?, ?, ?, ?, ?)
+               on conflict (chat_id) do update set title = excluded.title, favorite = excluded.favorite""",
+            (chat["chat_id"], username, chat.get("title", "New Chat"), int(chat.get("favorite", False)),
+             now, chat.get("updated_at", now))
+        )
+
+
+def append_message(username: str, chat: dict, position: int, question: str, answer: str):
+    """Store one message and bump its chat, in a single transaction"""
+    now = chat.get("updated_at", time.time())
+    with _connect() as conn, conn:
+        conn.execute(
+            """insert into chats (chat_id, username, title, favorite, created_at, updated_at) values (?, ?, ?, ?, ?, ?)
+               on conflict (chat_id) do update set title = excluded.title, updated_at = excluded.updated_at""",
+            (chat["chat_id"], username, chat.get("title", "New Chat"), int(chat.get("favorite", False)), now, now)
+        )
+        conn.execute(
+            """insert into messages (chat_id, position, question, answer, created_at) values (?, ?, ?, ?, ?)
+               on conflict (chat_id, position) do update set question = excluded.question, answer = excluded.answer""",
+            (chat["chat_id"], position, question, str(answer), now)
+        )
+
+
+def delete_chat(chat_id: str):
+    with _connect() as conn, conn:
+        conn.execute("delete from messages where chat_id = ?", (chat_id,))
+        conn.execute("delete from chats where chat_id = ?", (chat_id,))
+
+
+def _match_expression(query: str) -> str:
+    """Quote every word of free text for FTS5; the last word also matches as a prefix"""
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_messages(username: str, query: str, limit: int = 20) -> list[dict]:
+    """
+    Best matching messages of a user across all chats.
+    Returns dicts with chat_id, position (index in the chat's messages), title and a highlighted snippet.
+    """
+    expression = _match_expression(query)
+    if not expression:
+        return []
+    with _connect() as conn:
+        rows = conn.execute(
+            """select m.chat_id, m.position, c.title,
+                      snippet(messages_fts, -1, '**', '**', '…', ?) as snippet
+               from messages_fts
+               join messages m on m.rowid = messages_fts.rowid
+               join chats c on c.chat_id = m.chat_id
+               where messages_fts match ? and c.username = ?
+               order by bm25(messages_fts)
+               limit ?""",
+            (SEARCH_SNIPPET_TOKENS, expression, username, limit)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def import_sessions(username: str, sessions: list[dict]):
+    """Bulk load chats in the old JSON layout, keeping their order"""
+    now = time.time()
+    with _connect() as conn, conn:
+        for order, chat in enumerate(sessions):
+            created_at = now + order * 1e-6
+            conn.execute(
+                """insert or replace into chats (chat_id, username, title, favorite, created_at, updated_at)
+                   values (?, ?, ?, ?, ?, ?)""",
+                (chat["chat_id"], username, chat.get("title", "New Chat"), int(chat.get("favorite", False)),
+                 created_at, created_at)
+            )
+            conn.executemany(
+                """insert into messages (chat_id, position, question, answer, created_at) values (?, ?, ?, ?, ?)
+                   on conflict (chat_id, position) do update set question = excluded.question, answer = excluded.answer""",
+                [(chat["chat_id"], position, message["question"], str(message["answer"]), created_at)
+                 for position, message in enumerate(chat.get("messages", []))]
+            )
+
+
+def migrate_json_history(username: str, filename: str) -> bool:
+    """Import a legacy JSON chat history file once, then set it aside"""
+    try:
+        with open(filename, "r") as f:
+            sessions = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error migrating chat history {filename}: {e}")
+        return False
+    import_sessions(username, sessions)
+    os.replace(filename, filename + ".migrated")
+    return True
@@ -0,0 +1,101 @@
+import hashlib, re, threading
+from collections import OrderedDict
+from tokenizer import count_tokens, get_encoding
+from modelregistry import get_model
+
+# Context sources in the order they are kept when the budget is tight
+SOURCE_PRIORITY = {"upload": 0, "knowledge_base": 1, "web": 2, "crawl": 3}
+# Upper bound on context tokens per request, whatever the window: input tokens drive both cost and latency
+MAX_CONTEXT_TOKENS = 8000
+# A source is only truncated when at least this many tokens of it fit
+MIN_TRUNCATED_TOKENS = 64
+# Token counts kept for recently packed texts, keyed on a digest so whole documents are not held in memory
+TOKEN_CACHE_MAX_ENTRIES = 1024
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+_token_counts = OrderedDict()  # digest of text -> token count, least recently used first
+_token_counts_lock = threading.Lock()
+
+
+def _tokens(text: str) -> int:
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = count_tokens(text)
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_CACHE_MAX_ENTRIES:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def context_budget(model: str, reserved_text: str = "", max_output_tokens: int = 1000) -> int:
+    """Tokens left for context once the output reservation and the fixed prompt text are taken"""
+    window = get_model(model)["context_window"]
+    available = window - max_output_tokens - (_tokens(reserved_text) if reserved_text else 0)
+    return max(0, min(MAX_CONTEXT_TOKENS, available))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of whole sentences within max_tokens; a first sentence that is too long is cut at a word"""
+    kept, used = [], 0
+    position = 0
+    for match in _SENTENCE_END.finditer(text + "\n"):
+        sentence = text[position:match.end()]
+        tokens = _tokens(sentence)
+        if used + tokens > max_tokens:
+            break
+        kept.append(sentence)
+        used += tokens
+        position = match.end()
+    if not kept and max_tokens > 0:
+        encoding = get_encoding()
+        prefix = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+        return prefix.rsplit(" ", 1)[0].rstrip() if " " in prefix else prefix
+    return "".join(kept).rstrip()
+
+
+def pack_context(sources: list[dict], max_tokens: int, separator: str = "\n\n") -> tuple[str, list[dict]]:
+    """
+    Fit context sources into a token budget, best sources first.
+
+    Args:
+        sources: Dicts with "kind" (a SOURCE_PRIORITY key), "text" and optionally "label", "id" and
+            "max_tokens" (a cap for that source alone). Sources of the same kind keep their order (e.g. retrieval rank).
+        max_tokens: Token budget of the packed context
+
+    Returns:
+        The packed context and the sources it contains; a shortened source is marked "truncated".
+    """
+    ordered = sorted(sources, key=lambda source: SOURCE_PRIORITY.get(source["kind"], len(SOURCE_PRIORITY)))
+    separator_tokens = _tokens(separator)
+    kept, dropped = [], []
+    remaining = max_tokens
+    for source in ordered:
+        text = source["text"].strip()
+        if not text:
+            continue
+        capped = False
+        if source.get("max_tokens") and _tokens(text) > source["max_tokens"]:
+            text, capped = truncate_to_tokens(text, source["max_tokens"]), True
+        cost = _tokens(text) + (separator_tokens if kept else 0)
+        if cost <= remaining:
+            kept.append({**source, "text": text, "truncated": capped})
+            remaining -= cost
+            continue
+        room = remaining - (separator_tokens if kept else 0)
+        truncated = truncate_to_tokens(text, room) if room >= MIN_TRUNCATED_TOKENS else ""
+        if truncated:
+            kept.append({**source, "text": truncated, "truncated": True})
+            remaining -= _tokens(truncated) + (separator_tokens if len(kept) > 1 else 0)
+        else:
+            dropped.append(source)
+
+    truncated_labels = [source.get("label", source["kind"]) for source in kept if source.get("truncated")]
+    if dropped or truncated_labels:
+        print(f"Context packer: budget {max_tokens} tokens, kept {len(kept)} of {len(ordered)} sources, "
+              f"truncated {truncated_labels}, dropped {[source.get('label', source['kind']) for source in dropped]}")
+    return separator.join(source["text"] for source in kept), kept
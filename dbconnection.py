@@ -0,0 +1,61 @@
+import contextlib, os, queue, sqlite3, threading
+
+# Shared SQLite access: a process-wide pool of long-lived connections per database, in WAL mode,
+# so statements stay prepared in the connections' statement caches across reruns and script threads
+BUSY_TIMEOUT_SECONDS = 30
+STATEMENT_CACHE_SIZE = 256
+# Idle connections kept per database; extra ones opened under load are closed when returned
+POOL_SIZE = 4
+
+_pools: dict = {}   # db_path -> LifoQueue of idle connections
+_pools_lock = threading.Lock()
+
+
+def _open(db_path: str) -> sqlite3.Connection:
+    # Pooled connections move between threads, but only one thread uses a connection at a time
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _get_pool(db_path: str, setup=None) -> queue.LifoQueue:
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                directory = os.path.dirname(db_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                conn = _open(db_path)
+                if setup is not None:
+                    setup(conn)
+                pool = queue.LifoQueue(maxsize=POOL_SIZE)
+                pool.put(conn)
+                _pools[db_path] = pool
+    return pool
+
+
+@contextlib.contextmanager
+def get_connection(db_path: str, setup=None):
+    """
+    Check out a pooled connection to db_path for the duration of a with block.
+    setup(conn) runs once per database per process, e.g. to create tables.
+    """
+    pool = _get_pool(db_path, setup)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open(db_path)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
@@ -0,0 +1,97 @@
+import hashlib, os, sqlite3, threading, unicodedata
+import numpy as np
+
+# Local, content-addressed store of embeddings: one row per (model, normalized text)
+EMBEDDING_CACHE_PATH = "embedding_cache.db"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different copies of the same chunk share one cache entry"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_key(model_name: str, text: str) -> str:
+    """Cache key: model name plus a hash of the normalized text"""
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddingFunction:
+    """
+    Wraps a chroma embedding function with a persistent SQLite cache.
+    Only texts that are not cached yet are sent to the wrapped function, in a single call.
+
+    Args:
+        embedding_function: The chroma embedding function to wrap (e.g. OpenAIEmbeddingFunction)
+        model_name: Embedding model name, part of every cache key
+        db_path: Path of the SQLite cache file
+    """
+    def __init__(self, embedding_function, model_name: str, db_path: str = EMBEDDING_CACHE_PATH):
+        self._embedding_function = embedding_function
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("create table if not exists embeddings (key text primary key, vector blob not null)")
+        self._conn.commit()
+
+    def __call__(self, input):
+        texts = [input] if isinstance(input, str) else list(input)
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        cached = self._lookup(set(keys))
+
+        # Batch every distinct miss into one call of the wrapped function
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self._embedding_function(list(missing.values()))
+            fresh = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+            self._store(fresh)
+            cached.update(fresh)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, input):
+        return self(input)
+
+    def stats(self) -> dict:
+        """Return the hit and miss counters since the process started"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _lookup(self, keys: set) -> dict:
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            # Stay below SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"select key, vector from embeddings where key in ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _store(self, vectors: dict):
+        with self._lock:
+            self._conn.executemany(
+                "insert or replace into embeddings (key, vector) values (?, ?)",
+                [(key, vector.tobytes()) for key, vector in vectors.items()]
+            )
+            self._conn.commit()
+
+    def __getattr__(self, name):
+        # Delegate name(), get_config() and friends to the wrapped function so chroma sees the same embedding config
+        if name == "_embedding_function":
+            raise AttributeError(name)
+        return getattr(self._embedding_function, name)
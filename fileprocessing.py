@@ -1,94 +1,578 @@
-import os, tempfile #, ocrmypdf, openpyxl, fitz, pytesseract, io
+import os, multiprocessing, tempfile, threading, hashlib, sqlite3, io, csv, functools, itertools, mmap, zipfile, tarfile, gzip, bz2, lzma #, ocrmypdf, openpyxl, fitz, pytesseract
 import pandas as pd
 import streamlit as st
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from docx import Document as DocxDocument
 from PIL import Image
 # Langchain imports
-from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
+from tokenizer import count_tokens
 
-# Process documents for the user: import os, tempfile, pandas, langchain_text_splitters, langchain_core.documents, PyMuPDFLoader, Document
+CODE_EXTENSIONS = ["py", "r", "js", "jsx", "ts", "tsx", "html", "htm", "xml", "css", "scss", "less",
+                   "java", "c", "h", "cpp", "hpp", "cxx", "cc", "cs", "php", "rb", "go", "sh",
+                   "bash", "swift", "kt", "kts", "rs", "scala", "pl", "pm", "sql", "yaml", "yml"]
+SUPPORTED_EXTENSIONS = ["docx", "pdf", "txt", "xls", "xlsm", "xlsx", "csv"] + CODE_EXTENSIONS
+# Archives are opened in memory (zip/tar); 7z and rar go through pyunpack/patool, which needs a temp directory.
+# A gz/bz2/xz file is a tar when named *.tar.gz etc., otherwise a single compressed file (e.g. report.csv.gz)
+ARCHIVE_EXTENSIONS = ["zip", "tar", "tgz", "gz", "tbz2", "bz2", "txz", "xz", "7z", "rar"]
+COMPRESSED_FILE_OPENERS = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+ARCHIVE_MAX_WORKERS = 4
+ARCHIVE_MAX_MEMBER_BYTES = 200 * 1024 * 1024
+# Code files are split on function/class boundaries of their language; the others fall back to the prose splitter
+CODE_LANGUAGES = {
+    "py": Language.PYTHON, "js": Language.JS, "jsx": Language.JS, "ts": Language.TS, "tsx": Language.TS,
+    "java": Language.JAVA, "c": Language.CPP, "h": Language.CPP, "cpp": Language.CPP, "hpp": Language.CPP,
+    "cxx": Language.CPP, "cc": Language.CPP, "cs": Language.CSHARP, "php": Language.PHP, "rb": Language.RUBY,
+    "go": Language.GO, "swift": Language.SWIFT, "kt": Language.KOTLIN, "kts": Language.KOTLIN,
+    "rs": Language.RUST, "scala": Language.SCALA, "pl": Language.PERL, "pm": Language.PERL,
+    "html": Language.HTML, "htm": Language.HTML,
+}
+
+# Chunk sizes are measured in tokens of the embedding model
+CHUNK_SIZE_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 48
+
+# PDF extraction: pages are spread over a process pool in ranges, with a bounded number of ranges in flight
+PDF_PAGES_PER_TASK = 16
+PDF_MAX_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+PDF_MAX_IN_FLIGHT = 2 * PDF_MAX_WORKERS
+# OCR of image-only PDF pages: render resolution, bounded worker pool and per (file hash, page) result cache
+OCR_DPI = 300
+OCR_LANGUAGE = "eng"
+OCR_MAX_WORKERS = 2
+OCR_CACHE_PATH = "ocr_cache.db"
+# Rows read from a CSV at a time; spreadsheets are iterated row by row
+CSV_ROWS_PER_READ = 10_000
+# Number of chunks handed to the vector store at a time while a document is still being extracted
+STREAM_BATCH_SIZE = 64
+
+# Worker processes are spawned, not forked: a fork of the multithreaded server can inherit a lock held by another thread
+_mp_context = multiprocessing.get_context("spawn")
+_pdf_pool = None
+_ocr_pool = None
+_pool_lock = threading.Lock()
+_ocr_cache_lock = threading.Lock()
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_MAX_WORKERS, mp_context=_mp_context)
+        return _pdf_pool
+
+
+def _get_ocr_pool() -> ProcessPoolExecutor:
+    global _ocr_pool
+    with _pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_MAX_WORKERS, mp_context=_mp_context)
+        return _ocr_pool
+
+
+def _ocr_cache_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(OCR_CACHE_PATH)
+    conn.execute("create table if not exists ocr_pages (file_hash text, page integer, text text, primary key (file_hash, page))")
+    return conn
+
+
+def _get_cached_ocr(file_hash: str, page_no: int):
+    with _ocr_cache_lock:
+        conn = _ocr_cache_connect()
+        row = conn.execute("select text from ocr_pages where file_hash = ? and page = ?", (file_hash, page_no)).fetchone()
+        conn.close()
+    return row[0] if row else None
+
+
+def _cache_ocr(file_hash: str, page_no: int, text: str):
+    with _ocr_cache_lock:
+        conn = _ocr_cache_connect()
+        conn.execute("insert or replace into ocr_pages values (?, ?, ?)", (file_hash, page_no, text))
+        conn.commit()
+        conn.close()
+
+
+class _BufferStream(io.RawIOBase):
+    """Read-only, seekable stream over a buffer (e.g. an mmap) that reads through a memoryview instead of copying it"""
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = max(0, min(len(b), len(self._view) - self._position))
+        b[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            # Release the view, otherwise the mmap behind it cannot be closed
+            self._view.release()
+        super().close()
+
+
+class UploadSource:
+    """
+    An upload held once in memory: the uploaded bytes (shared, not copied) or an mmap of a file on disk.
+    Loaders read from in-memory streams; a temp file is only written when a worker process needs a path.
+    """
+    def __init__(self, name: str, data, path: str = None, file=None):
+        self.name = name
+        self.extension = name.split(".")[-1].lower()
+        self.data = data
+        self.path = path
+        self._file = file
+        self._spooled = False
+        self._hash = None
+
+    @classmethod
+    def from_uploaded_file(cls, uploaded_file: UploadedFile) -> "UploadSource":
+        # getvalue() returns the upload's own bytes object; getbuffer() would force a private copy
+        return cls(uploaded_file.name, uploaded_file.getvalue())
+
+    @classmethod
+    def from_path(cls, path: str, name: str = None) -> "UploadSource":
+        """Map a file on disk read-only, without reading it into memory"""
+        f = open(path, "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        return cls(name or os.path.basename(path), data, path=path, file=f)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def open(self):
+        """
+        A fresh binary stream over the data, positioned at the start. It shares self.data instead of copying it
+        and must be closed by the caller (use it in a with block).
+        """
+        if isinstance(self.data, mmap.mmap):
+            return io.BufferedReader(_BufferStream(self.data))
+        return io.BytesIO(self.data)
+
+    def text(self) -> str:
+        return str(self.data, "utf-8", "replace")
+
+    def content_hash(self) -> str:
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.data).hexdigest()
+        return self._hash
+
+    def ensure_path(self) -> str:
+        """Spool the data to a single temp file, once, for consumers that need a path"""
+        if self.path is None:
+            temp_file = tempfile.NamedTemporaryFile(suffix=f".{self.extension}", delete=False)
+            temp_file.write(self.data)
+            temp_file.close()
+            self.path = temp_file.name
+            self._spooled = True
+        return self.path
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self._file is not None:
+            self._file.close()
+        if self._spooled:
+            # Clean up the temp file
+            os.unlink(self.path)
+            self.path, self._spooled = None, False
+
+
+@functools.lru_cache(maxsize=None)
+def _text_splitter(file_extension: str = None) -> RecursiveCharacterTextSplitter:
+    """Token-based splitter for a file type, built once per type"""
+    if file_extension in CODE_LANGUAGES:
+        return RecursiveCharacterTextSplitter.from_language(
+            CODE_LANGUAGES[file_extension], chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS,
+            length_function=count_tokens
+        )
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS, length_function=count_tokens,
+        separators=["\n\n", "\n", ".", "?", "!", " ", ""]
+    )
+
+
+def _split_documents(documents: list[Document], file_extension: str = None) -> list[Document]:
+    """Split documents into chunks, dropping empty ones; each chunk carries its token_count"""
+    splits_raw = _text_splitter(file_extension).split_documents(documents)
+    all_splits = []
+    # Extract content and filter out empty chunks
+    for split in splits_raw:
+        content = split.page_content.strip()
+        if content:
+            all_splits.append(Document(page_content=content, metadata={**split.metadata, "token_count": count_tokens(content)}))
+    return all_splits
+
+
+def _csv_line(values) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="").writerow(values)
+    return buffer.getvalue()
+
+
+def _split_table_rows(header: str, rows, metadata: dict) -> Iterator[Document]:
+    """
+    Pack (row number, CSV line) pairs into row-group chunks of up to CHUNK_SIZE_TOKENS, repeating the header in every chunk.
+    Row numbers are 1-based data rows of the source table, skipped rows included, and are stored as row_start/row_end.
+    """
+    header_tokens = count_tokens(header) + 1
+    lines, tokens, row_start, row_end = [], header_tokens, None, None
+
+    def make_chunk(row_end):
+        content = "\n".join([header] + lines)
+        return Document(page_content=content, metadata={**metadata, "row_start": row_start, "row_end": row_end,
+                                                        "token_count": tokens})
+
+    for row_no, line in rows:
+        line_tokens = count_tokens(line) + 1
+        if lines and tokens + line_tokens > CHUNK_SIZE_TOKENS:
+            yield make_chunk(row_end)
+            lines, tokens = [], header_tokens
+        if not lines:
+            row_start = row_no
+        lines.append(line)
+        tokens += line_tokens
+        row_end = row_no
+    if lines:
+        yield make_chunk(row_end)
+
+
+def _iter_csv_rows(stream):
+    """
+    Return (header, (row number, row line) pairs) of a CSV read in chunks of CSV_ROWS_PER_READ rows,
+    so memory stays flat whatever the file size. The header is None for an empty file.
+    Cells are read as the strings in the file: no per-chunk type inference (02134 stays 02134) and no NaN for empty cells.
+    """
+    reader = pd.read_csv(stream, chunksize=CSV_ROWS_PER_READ, dtype=str, keep_default_na=False)
+    first_chunk = next(reader, None)
+    if first_chunk is None:
+        return None, iter(())
+
+    def lines():
+        for chunk_df in itertools.chain([first_chunk], reader):
+            for values in chunk_df.itertuples(index=False, name=None):
+                yield _csv_line(values)
+    return _csv_line(first_chunk.columns), enumerate(lines(), start=1)
+
+
+def _iter_excel_sheets(stream, file_extension: str):
+    """Yield (sheet_name, header, (row number, row line) pairs) per sheet, one sheet in memory at most"""
+    if file_extension in ["xlsx", "xlsm"]:
+        import openpyxl
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                rows = sheet.iter_rows(values_only=True)
+                first_row = next(rows, None)
+                if first_row is None:
+                    continue
+                header = _csv_line(["" if value is None else value for value in first_row])
+                # Rows are numbered before blank ones are dropped, so row numbers match the sheet
+                lines = ((row_no, _csv_line(["" if value is None else value for value in row]))
+                         for row_no, row in enumerate(rows, start=1) if any(value is not None for value in row))
+                yield sheet.title, header, lines
+        finally:
+            workbook.close()
+    else:
+        # Legacy .xls is not supported by openpyxl: read it one sheet at a time
+        excel_file = pd.ExcelFile(stream)
+        for sheet_name in excel_file.sheet_names:
+            sheet_df = excel_file.parse(sheet_name, keep_default_na=False)
+            header = _csv_line(sheet_df.columns)
+            yield sheet_name, header, enumerate((_csv_line(values) for values in sheet_df.itertuples(index=False, name=None)),
+                                                start=1)
+
+
+def _extract_pages(pdf, start: int, stop: int) -> list[tuple[int, str, bool]]:
+    """Extract (page_no, text, needs_ocr) per page; a page needs OCR when it has images but no text layer"""
+    pages = []
+    for page_no in range(start, stop):
+        page = pdf[page_no]
+        text = page.get_text()
+        pages.append((page_no, text, not text.strip() and bool(page.get_images())))
+    return pages
+
+
+# Runs in a worker process: must stay a module-level function so it can be pickled
+def _extract_pdf_pages(path: str, start: int, stop: int) -> list[tuple[int, str, bool]]:
+    import fitz
+    with fitz.open(path) as pdf:
+        return _extract_pages(pdf, start, stop)
+
+
+# Runs in a worker process: renders a single page and runs Tesseract on it
+def _ocr_pdf_page(path: str, page_no: int, dpi: int, language: str) -> tuple[int, str]:
+    import fitz, pytesseract
+    with fitz.open(path) as pdf:
+        pixmap = pdf[page_no].get_pixmap(dpi=dpi)
+    image = Image.open(io.BytesIO(pixmap.tobytes("png")))
+    return page_no, pytesseract.image_to_string(image, lang=language)
+
+
+def iter_pdf_pages(upload: UploadSource) -> Iterator[Document]:
+    """
+    Yield one Document per PDF page as soon as its page range is extracted.
+    Small files are read in-process straight from memory. Large files are spooled once and extracted in parallel;
+    only PDF_MAX_IN_FLIGHT ranges are held in memory at once.
+    Image-only pages are rendered and OCRed on a separate bounded pool, with results cached per (file hash, page).
+    """
+    import fitz
+    # PyMuPDF reads the in-memory bytes directly, no temp file
+    pdf = fitz.open(upload.path) if upload.path else fitz.open(stream=upload.data, filetype="pdf")
+    total_pages = pdf.page_count
+    source = upload.name
+
+    def to_document(page_no, text, ocr=False):
+        metadata = {"source": source, "page": page_no, "total_pages": total_pages}
+        if ocr:
+            metadata["ocr"] = True
+        return Document(page_content=text, metadata=metadata)
+
+    ranges = iter([(start, min(start + PDF_PAGES_PER_TASK, total_pages))
+                   for start in range(0, total_pages, PDF_PAGES_PER_TASK)])
+    # Small files are extracted in-process; OCR always goes through its own pool
+    pool = _get_pdf_pool() if total_pages > PDF_PAGES_PER_TASK else None
+    path = upload.ensure_path() if pool is not None else None
+    pending, ocr_pending = set(), set()
+    try:
+        while True:
+            for start, stop in ranges:
+                if pool is None:
+                    future = Future()
+                    future.set_result(_extract_pages(pdf, start, stop))
+                else:
+                    future = pool.submit(_extract_pdf_pages, path, start, stop)
+                pending.add(future)
+                if len(pending) >= PDF_MAX_IN_FLIGHT:
+                    break
+            if not pending and not ocr_pending:
+                return
+            done, _ = wait(pending | ocr_pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in ocr_pending:
+                    ocr_pending.discard(future)
+                    try:
+                        page_no, text = future.result()
+                    except Exception as e:
+                        print(f"OCR failed for a page of {source}: {e}")
+                        continue
+                    _cache_ocr(upload.content_hash(), page_no, text)
+                    yield to_document(page_no, text, ocr=True)
+                    continue
+
+                pending.discard(future)
+                for page_no, text, needs_ocr in future.result():
+                    if not needs_ocr:
+                        yield to_document(page_no, text)
+                        continue
+                    cached_text = _get_cached_ocr(upload.content_hash(), page_no)
+                    if cached_text is not None:
+                        yield to_document(page_no, cached_text, ocr=True)
+                    else:
+                        ocr_pending.add(_get_ocr_pool().submit(
+                            _ocr_pdf_page, upload.ensure_path(), page_no, OCR_DPI, OCR_LANGUAGE
+                        ))
+    finally:
+        for future in pending | ocr_pending:
+            future.cancel()
+        pdf.close()
+
+
+def _batched(splits: Iterator[Document], batch_size: int) -> Iterator[list[Document]]:
+    batch = []
+    for split in splits:
+        batch.append(split)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_archive_members(upload: UploadSource) -> Iterator[tuple[str, bytes]]:
+    """Yield (member name, bytes) of every regular file in an archive, one member in memory at a time"""
+    if upload.extension == "zip":
+        with upload.open() as stream, zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.file_size <= ARCHIVE_MAX_MEMBER_BYTES:
+                    yield info.filename, archive.read(info)
+    elif upload.extension in ["7z", "rar"]:
+        from pyunpack import Archive
+        with tempfile.TemporaryDirectory() as extract_dir:
+            Archive(upload.ensure_path()).extractall(extract_dir)
+            for root, _, files in os.walk(extract_dir):
+                for file_name in files:
+                    path = os.path.join(root, file_name)
+                    if os.path.getsize(path) <= ARCHIVE_MAX_MEMBER_BYTES:
+                        with open(path, "rb") as f:
+                            yield os.path.relpath(path, extract_dir), f.read()
+    elif upload.extension in COMPRESSED_FILE_OPENERS and not upload.name.lower().endswith(f".tar.{upload.extension}"):
+        # A single compressed file: its only member is the file name without the compression suffix
+        member_name = os.path.basename(upload.name)[:-len(upload.extension) - 1]
+        with upload.open() as stream, COMPRESSED_FILE_OPENERS[upload.extension](stream) as f:
+            data = f.read(ARCHIVE_MAX_MEMBER_BYTES + 1)
+        if len(data) <= ARCHIVE_MAX_MEMBER_BYTES:
+            yield member_name, data
+    else:
+        with upload.open() as stream, tarfile.open(fileobj=stream, mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and member.size <= ARCHIVE_MAX_MEMBER_BYTES:
+                    yield member.name, archive.extractfile(member).read()
+
+
+def _process_archive_member(archive_name: str, member_name: str, data: bytes, member_hash: str) -> list[Document]:
+    """Run one archive member through the per-extension handlers; runs on the archive worker pool"""
+    member = UploadSource(f"{archive_name}/{member_name}", data)
+    try:
+        splits = list(_iter_splits(member))
+    except Exception as e:
+        print(f"Skipping {member.name}: {e}")
+        return []
+    finally:
+        member.close()
+    for split in splits:
+        split.metadata.update({"archive_member": member_name, "member_hash": member_hash})
+    return splits
+
+
+def _iter_archive_splits(upload: UploadSource, skip_members: dict = None, skipped_members: set = None) -> Iterator[Document]:
+    """
+    Yield the chunks of every supported archive member. Members are processed in parallel, a bounded number at a time.
+    Duplicate members (same content hash) are processed once; members listed in skip_members with an unchanged hash
+    are skipped and reported in skipped_members.
+    """
+    skip_members = skip_members or {}
+    seen_hashes = set()
+    members = _iter_archive_members(upload)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=ARCHIVE_MAX_WORKERS, thread_name_prefix="archive") as pool:
+        try:
+            while True:
+                for member_name, data in members:
+                    if member_name.split(".")[-1].lower() not in SUPPORTED_EXTENSIONS:
+                        continue
+                    member_hash = hashlib.sha256(data).hexdigest()
+                    if skip_members.get(member_name) == member_hash:
+                        if skipped_members is not None:
+                            skipped_members.add(member_name)
+                        continue
+                    if member_hash in seen_hashes:
+                        continue
+                    seen_hashes.add(member_hash)
+                    pending.add(pool.submit(_process_archive_member, upload.name, member_name, data, member_hash))
+                    if len(pending) >= 2 * ARCHIVE_MAX_WORKERS:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _iter_splits(upload: UploadSource) -> Iterator[Document]:
+    """Load an upload from memory and yield its chunks; PDF chunks are produced page by page"""
+    file_extension, source = upload.extension, upload.name
+    if file_extension == "pdf":
+        has_text = False
+        for page in iter_pdf_pages(upload):
+            if page.page_content.strip():
+                has_text = True
+                yield from _split_documents([page], file_extension)
+        if not has_text:
+            raise ValueError("Failed to read document, no text found even after OCR.")
+        return
+
+    documents = []
+    if file_extension == "docx":
+        with upload.open() as stream:
+            doc = DocxDocument(stream)
+        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        documents.append(Document(page_content=text, metadata={"source": source}))
+    elif file_extension == "txt" or file_extension in CODE_EXTENSIONS:
+        # Decode text and code files directly from the buffer
+        documents.append(Document(page_content=upload.text(), metadata={"source": source}))
+    elif file_extension in ["xls", "xlsm", "xlsx"]:
+        # Tables are streamed row by row into row-group chunks instead of split by characters
+        with upload.open() as stream:
+            for sheet_name, header, lines in _iter_excel_sheets(stream, file_extension):
+                yield from _split_table_rows(header, lines, {"source": f"{source} - {sheet_name}", "sheet": str(sheet_name)})
+    elif file_extension == "csv":
+        with upload.open() as stream:
+            header, lines = _iter_csv_rows(stream)
+            if header is not None:
+                yield from _split_table_rows(header, lines, {"source": source})
+    yield from _split_documents(documents, file_extension)
+
+
+def iter_document_batches(uploaded_file, batch_size: int = STREAM_BATCH_SIZE, skip_members: dict = None,
+                          skipped_members: set = None) -> Iterator[list[Document]]:
+    """
+    Process an uploaded document and yield its chunks in batches while extraction is still running,
+    so the first batches can be added to the vector store before the whole file is read.
+    Accepts a Streamlit UploadedFile or an UploadSource. Raises on unsupported or unreadable files.
+
+    For archives, every member's chunks carry archive_member/member_hash metadata. Members named in
+    skip_members (member name -> content hash) whose hash is unchanged are not processed and are added to skipped_members.
+    """
+    upload = uploaded_file if isinstance(uploaded_file, UploadSource) else UploadSource.from_uploaded_file(uploaded_file)
+    if upload.extension not in SUPPORTED_EXTENSIONS + ARCHIVE_EXTENSIONS:
+        raise ValueError(f"Unsupported file format: {upload.extension}. Please upload a PDF, DOCX, TXT, Excel, CSV or archive file.")
+    try:
+        if upload.extension in ARCHIVE_EXTENSIONS:
+            yield from _batched(_iter_archive_splits(upload, skip_members, skipped_members), batch_size)
+        else:
+            yield from _batched(_iter_splits(upload), batch_size)
+    finally:
+        if upload is not uploaded_file:
+            upload.close()
+
+
+def file_content_hash(uploaded_file: UploadedFile) -> str:
+    """SHA-256 of the uploaded bytes, used to skip files that are already indexed"""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+# Process documents for the user: import os, pandas, langchain_text_splitters, langchain_core.documents, PyMuPDF, Document
 def process_document(uploaded_file: UploadedFile) -> tuple:
     """
     Process various document types and split them into chunks for vector storage.
-    
+
     Args:
         uploaded_file: The uploaded file to process
-        
+
     Returns:
         A tuple containing (all_splits, file_size_bytes)
     """
-    # Store uploaded file as a temp file before it goes to vector database
     file_extension = uploaded_file.name.split(".")[-1].lower()
-    temp_file = tempfile.NamedTemporaryFile(suffix=f".{file_extension}", delete=False)
-    temp_file.write(uploaded_file.read())
-    temp_file.seek(0)
-    file_size_bytes = os.path.getsize(temp_file.name)
-    temp_file.close()
-    documents = []
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500, chunk_overlap=100, separators=["\n\n", "\n", ".", "?", "!", " ", ""]
-    )
+    if file_extension not in SUPPORTED_EXTENSIONS + ARCHIVE_EXTENSIONS:
+        st.error(f"Unsupported file format: {file_extension}. Please upload a PDF, DOCX, TXT, Excel, CSV or archive file.")
+        return [], 0
 
     try:
-        if file_extension == "docx":
-            doc = DocxDocument(temp_file.name)
-            text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            documents.append(Document(page_content=text, metadata={"source": uploaded_file.name}))
-        elif file_extension == "pdf":
-            try:
-                # First try using OCRMyPDF to convert scanned images to searchable PDF
-                loader = PyMuPDFLoader(temp_file.name)
-                documents = loader.load()
-                if not any(doc.page_content.strip() for doc in documents):
-                    raise Exception("OCRMyPDF produced empty text")
-            except Exception as e:
-                # If OCRMyPDF fails, try manual OCR approach
-                st.error(f"Failed to read document, maybe this is a scanned pdf file. {str(e)}")
-        elif file_extension == "txt":
-            with open(temp_file.name, "r", encoding="utf-8", errors="replace") as f:
-                text = f.read()
-            documents.append(Document(page_content=text, metadata={"source": uploaded_file.name}))
-        elif file_extension in ["xls", "xlsm", "xlsx"]: 
-            excel_df = pd.read_excel(temp_file.name, sheet_name=None)
-            for sheet_name, sheet_df in excel_df.items():
-                text = sheet_df.to_csv(index=False)
-                documents.append(Document(page_content=text, metadata={"source": f"{uploaded_file.name} - {sheet_name}"}))
-        elif file_extension == "csv":
-            csv_df = pd.read_csv(temp_file.name)
-            text = csv_df.to_csv(index=False)
-            documents.append(Document(page_content=text, metadata = {"source": uploaded_file.name}))
-        
-        elif file_extension in ["py", "r", "js", "jsx", "ts", "tsx", "html", "htm", "xml", "css", "scss", "less", 
-                                "java", "c", "h", "cpp", "hpp", "cxx", "cc", "cs", "php", "rb", "go", "sh", 
-                                "bash", "swift", "kt", "kts", "rs", "scala", "pl", "pm", "sql", "yaml", "yml"]:
-            # Read code files as plain text
-            with open(temp_file.name, "r", encoding="utf-8", errors="replace") as f:
-                text = f.read()
-            documents.append(Document(page_content=text, metadata={"source": uploaded_file.name}))
-        else:
-            st.error(f"Unsupported file format: {file_extension}. Please upload a PDF, DOCX, TXT, Excel, or CSV file.")
-            os.unlink(temp_file.name)
-            return [], 0
+        all_splits = [split for batch in iter_document_batches(uploaded_file) for split in batch]
     except Exception as e:
         st.error(f"Error processing {file_extension} file: {str(e)}")
-        os.unlink(temp_file.name)
         return [], 0
 
-    # Split documents into chunks
-    all_splits = []
-    if documents:
-        splits_raw = text_splitter.split_documents(documents)
-        # Extract content and filter out empty chunks
-        all_splits = [Document(page_content=split.page_content.strip(), metadata=split.metadata) 
-                    for split in splits_raw if split.page_content.strip()]
-    
-    # Clean up the temp file
-    os.unlink(temp_file.name)
-    
-    return all_splits, file_size_bytes
-
-    
\ No newline at end of file
+    return all_splits, uploaded_file.size
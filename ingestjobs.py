@@ -0,0 +1,210 @@
+import os, threading, time, uuid
+import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+from dbconnection import get_connection
+from fileprocessing import UploadSource, iter_document_batches
+from vectordb import add_batches_to_collection, get_indexed_members
+
+# Get the API Key
+api_key = st.secrets["api_keys"]["openai"]
+
+# Background ingestion: job state survives restarts, uploads are spooled until their job finishes
+JOBS_DB_PATH = "ingest_jobs.db"
+SPOOL_DIR = "ingest_spool"
+INGEST_MAX_WORKERS = 2
+# How long deleting a chat waits for its running jobs to stop, and how often it checks
+CANCEL_WAIT_SECONDS = 60
+CANCEL_POLL_SECONDS = 0.2
+ACTIVE_STATUSES = ("queued", "running")
+# "status in (...)" with one bound parameter per active status
+_ACTIVE_PLACEHOLDERS = ", ".join("?" for _ in ACTIVE_STATUSES)
+
+_executor = None
+_executor_lock = threading.Lock()
+_cancel_events: dict = {}  # job_id -> threading.Event
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _setup(conn):
+    conn.execute("""
+        create table if not exists ingest_jobs (
+            job_id text primary key,
+            username text not null,
+            chat_id text not null,
+            file_name text not null,
+            collection_file_name text not null,
+            store_path text not null,
+            collection_name text not null,
+            file_hash text not null,
+            spool_path text not null,
+            status text not null,
+            progress real default 0,
+            chunks_done integer default 0,
+            error text,
+            created_at real not null,
+            updated_at real not null)
+    """)
+
+
+def _execute(query: str, params: tuple = ()) -> list:
+    # A pooled connection: the table is created once per process, not on every poll
+    with get_connection(JOBS_DB_PATH, _setup) as conn:
+        rows = [dict(row) for row in conn.execute(query, params).fetchall()]
+        conn.commit()
+    return rows
+
+
+def _update_job(job_id: str, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    _execute(f"update ingest_jobs set {assignments} where job_id = ?", (*fields.values(), job_id))
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Start the worker pool on first use and requeue jobs left unfinished by a previous process"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix="ingest")
+            for job in _execute(f"select job_id from ingest_jobs where status in ({_ACTIVE_PLACEHOLDERS})",
+                                ACTIVE_STATUSES):
+                _schedule(job["job_id"])
+        return _executor
+
+
+def _schedule(job_id: str):
+    _cancel_events[job_id] = threading.Event()
+    _executor.submit(_run_job, job_id)
+
+
+def _track_progress(job_id: str, split_batches, cancel_event: threading.Event):
+    """Pass batches through, recording progress once the previous batch is stored and honouring cancellation"""
+    chunks_done = 0
+    for batch in split_batches:
+        if cancel_event.is_set():
+            raise JobCancelled()
+        yield batch
+        chunks_done += len(batch)
+        metadata = batch[-1].metadata
+        fields = {"chunks_done": chunks_done}
+        if metadata.get("total_pages"):
+            fields["progress"] = min(1.0, (metadata["page"] + 1) / metadata["total_pages"])
+        _update_job(job_id, **fields)
+
+
+def _run_job(job_id: str):
+    """process_document -> embed -> upsert for one job; safe to re-run after a crash (chunk ids are content hashes)"""
+    jobs = _execute("select * from ingest_jobs where job_id = ?", (job_id,))
+    if not jobs:
+        return
+    job = jobs[0]
+    if job["status"] not in ACTIVE_STATUSES:
+        # Cancelled while queued
+        _cancel_events.pop(job_id, None)
+        if os.path.exists(job["spool_path"]):
+            os.unlink(job["spool_path"])
+        return
+    cancel_event = _cancel_events.get(job_id) or threading.Event()
+    _update_job(job_id, status="running", error=None)
+    upload = None
+    try:
+        upload = UploadSource.from_path(job["spool_path"], job["file_name"])
+        # Archive members that did not change since the last upload are neither extracted nor embedded again
+        indexed_members = get_indexed_members(job["store_path"], job["collection_name"], job["collection_file_name"])
+        unchanged_members = set()
+        split_batches = _track_progress(
+            job_id, iter_document_batches(upload, skip_members=indexed_members, skipped_members=unchanged_members),
+            cancel_event
+        )
+        add_batches_to_collection(split_batches, job["collection_file_name"], api_key,
+                                  job["store_path"], job["collection_name"], file_hash=job["file_hash"],
+                                  unchanged_members=unchanged_members)
+        _update_job(job_id, status="done", progress=1.0)
+    except JobCancelled:
+        _update_job(job_id, status="cancelled")
+    except Exception as e:
+        print(f"Ingestion job {job_id} failed: {e}")
+        _update_job(job_id, status="failed", error=str(e))
+    finally:
+        if upload is not None:
+            upload.close()
+        _cancel_events.pop(job_id, None)
+        if os.path.exists(job["spool_path"]):
+            os.unlink(job["spool_path"])
+
+
+def submit_ingest_job(uploaded_file, username: str, chat_id: str, collection_file_name: str,
+                      store_path: str, collection_name: str, file_hash: str) -> str:
+    """
+    Queue an upload for background ingestion and return its job id.
+    Submitting a file that is already queued or running for the same store returns the existing job.
+    """
+    _get_executor()
+    existing = _execute(
+        f"select job_id from ingest_jobs where store_path = ? and collection_file_name = ? and file_hash = ? "
+        f"and status in ({_ACTIVE_PLACEHOLDERS})",
+        (store_path, collection_file_name, file_hash, *ACTIVE_STATUSES)
+    )
+    if existing:
+        return existing[0]["job_id"]
+
+    job_id = str(uuid.uuid4())
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(SPOOL_DIR, f"{job_id}.{uploaded_file.name.split('.')[-1].lower()}")
+    # The upload is persisted so the job can be restarted after a crash
+    with open(spool_path, "wb") as f:
+        f.write(uploaded_file.getvalue())
+    now = time.time()
+    _execute(
+        """insert into ingest_jobs (job_id, username, chat_id, file_name, collection_file_name, store_path,
+           collection_name, file_hash, spool_path, status, created_at, updated_at)
+           values (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)""",
+        (job_id, username, chat_id, uploaded_file.name, collection_file_name, store_path,
+         collection_name, file_hash, spool_path, now, now)
+    )
+    with _executor_lock:
+        _schedule(job_id)
+    return job_id
+
+
+def get_jobs(username: str, chat_id: str = None, active_only: bool = False) -> list[dict]:
+    """Jobs of a user (optionally of one chat), newest first"""
+    # Polling also makes sure unfinished jobs of a previous process are picked up again
+    _get_executor()
+    query = "select * from ingest_jobs where username = ?"
+    params = [username]
+    if chat_id is not None:
+        query += " and chat_id = ?"
+        params.append(chat_id)
+    if active_only:
+        query += f" and status in ({_ACTIVE_PLACEHOLDERS})"
+        params.extend(ACTIVE_STATUSES)
+    return _execute(query + " order by created_at desc", tuple(params))
+
+
+def cancel_job(job_id: str):
+    """Stop a job after its current batch; a queued job is cancelled before it starts"""
+    event = _cancel_events.get(job_id)
+    if event is not None:
+        event.set()
+    _execute("update ingest_jobs set status = 'cancelled', updated_at = ? where job_id = ? and status = 'queued'",
+             (time.time(), job_id))
+
+
+def cancel_chat_jobs(username: str, chat_id: str, timeout: float = CANCEL_WAIT_SECONDS) -> bool:
+    """
+    Cancel the queued and running jobs of a chat and wait until none of them can still write to its store.
+    Returns False when a job is still running after timeout seconds.
+    """
+    for job in get_jobs(username, chat_id, active_only=True):
+        cancel_job(job["job_id"])
+    # A running job only stops after its current batch and marks itself cancelled once its writes are done
+    deadline = time.monotonic() + timeout
+    while get_jobs(username, chat_id, active_only=True):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(CANCEL_POLL_SECONDS)
+    return True
@@ -0,0 +1,134 @@
+import math, os, re, sqlite3, threading
+from collections import Counter
+
+# BM25 inverted index stored as a SQLite file inside each chroma store directory
+LEXICAL_INDEX_FILENAME = "lexical_index.sqlite3"
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Words plus dotted/dashed/slashed identifiers such as "50.46", "ISO-9001" or "get_vector_collection"
+_TOKEN_PATTERN = re.compile(r"\w+(?:[.\-/:]\w+)*")
+
+_indexes: dict = {}
+_indexes_lock = threading.Lock()
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased terms; compound identifiers are indexed whole and by their parts"""
+    terms = []
+    for match in _TOKEN_PATTERN.findall(text.lower()):
+        terms.append(match)
+        if not match.isalnum():
+            terms.extend(part for part in re.split(r"[.\-/:_]", match) if part)
+    return terms
+
+
+class LexicalIndex:
+    """
+    Incremental BM25 index over the chunks of one chroma store.
+    Postings live in a WITHOUT ROWID table, so the file stays compact and queries need no loading step.
+    """
+    def __init__(self, store_path: str):
+        os.makedirs(store_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(store_path, LEXICAL_INDEX_FILENAME), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            create table if not exists docs (
+                collection text not null,
+                doc_id text not null,
+                length integer not null,
+                primary key (collection, doc_id)) without rowid;
+            create table if not exists postings (
+                collection text not null,
+                term text not null,
+                doc_id text not null,
+                tf integer not null,
+                primary key (collection, term, doc_id)) without rowid;
+            create index if not exists postings_doc on postings (collection, doc_id);
+            create table if not exists backfilled (
+                collection text primary key) without rowid;
+        """)
+        self._conn.commit()
+
+    def add(self, collection_name: str, ids: list[str], texts: list[str]):
+        """Index (or re-index) documents; existing postings of the same ids are replaced"""
+        with self._lock:
+            self._delete(collection_name, ids)
+            docs, postings = [], []
+            for doc_id, text in zip(ids, texts):
+                counts = Counter(tokenize(text))
+                docs.append((collection_name, doc_id, sum(counts.values())))
+                postings.extend((collection_name, term, doc_id, tf) for term, tf in counts.items())
+            self._conn.executemany("insert or replace into docs values (?, ?, ?)", docs)
+            self._conn.executemany("insert or replace into postings values (?, ?, ?, ?)", postings)
+            self._conn.commit()
+
+    def is_backfilled(self, collection_name: str) -> bool:
+        """True once the chunks stored before the index existed have been indexed"""
+        with self._lock:
+            return self._conn.execute(
+                "select 1 from backfilled where collection = ?", (collection_name,)
+            ).fetchone() is not None
+
+    def mark_backfilled(self, collection_name: str):
+        with self._lock:
+            self._conn.execute("insert or ignore into backfilled values (?)", (collection_name,))
+            self._conn.commit()
+
+    def delete(self, collection_name: str, ids: list[str]):
+        with self._lock:
+            self._delete(collection_name, ids)
+            self._conn.commit()
+
+    def _delete(self, collection_name: str, ids: list[str]):
+        rows = [(collection_name, doc_id) for doc_id in ids]
+        self._conn.executemany("delete from postings where collection = ? and doc_id = ?", rows)
+        self._conn.executemany("delete from docs where collection = ? and doc_id = ?", rows)
+
+    def search(self, collection_name: str, query: str, n_results: int = 10) -> list[tuple[str, float]]:
+        """Return up to n_results (doc_id, bm25 score) pairs, best first"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            num_docs, avg_length = self._conn.execute(
+                "select count(*), avg(length) from docs where collection = ?", (collection_name,)
+            ).fetchone()
+            if not num_docs:
+                return []
+            scores = Counter()
+            for term in terms:
+                rows = self._conn.execute(
+                    """select p.doc_id, p.tf, d.length from postings p
+                       join docs d on d.collection = p.collection and d.doc_id = p.doc_id
+                       where p.collection = ? and p.term = ?""",
+                    (collection_name, term)
+                ).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (num_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+                for doc_id, tf, length in rows:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores.most_common(n_results)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_lexical_index(store_path: str) -> LexicalIndex:
+    """Return the shared index of a chroma store, opening it on first use"""
+    store_path = os.path.abspath(store_path)
+    with _indexes_lock:
+        if store_path not in _indexes:
+            _indexes[store_path] = LexicalIndex(store_path)
+        return _indexes[store_path]
+
+
+def close_lexical_index(store_path: str):
+    with _indexes_lock:
+        index = _indexes.pop(os.path.abspath(store_path), None)
+    if index is not None:
+        index.close()
@@ -3,10 +3,14 @@ import requests, time, re
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
 # LLM Import
-from openai import OpenAI
-from uservalidate import update_user_cost
-from sentence_transformers import CrossEncoder
-from langchain import PromptTemplate, LLMChain
+from openaiclient import get_openai_client, model_timeout, request_slot, stream_chat_completion
+from uservalidate import record_usage
+from modelregistry import completion_params, get_model
+from reranker import get_reranker
+from contextpacker import pack_context
+from responsecache import get_response_cache, replay_response
+from vectordb import get_embedding_function
+from langchain import PromptTemplate
 from chatFunctions import append_message_to_current_chat
 
 # Instruction prompt for the AI assistant
@@ -124,106 +128,102 @@ system_prompt_analysis = """
     • Encourage user engagement for more tailored and precise outputs.
 """
 
+# Models behind the chat and reasoning modes, and the completion tokens reserved for their answers
+CHAT_MODEL = "gpt-4o-mini"
+REASONING_MODEL = "o3-mini"
+MAX_OUTPUT_TOKENS = 1000
+
+def _record_completion_usage(model: str, usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    record_usage(st.session_state["username"], model, usage.prompt_tokens, usage.completion_tokens,
+                 cached_tokens=getattr(details, "cached_tokens", None) or 0)
+
+def stream_content(response, model: str):
+    """
+    Yield the text deltas of a streamed chat completion.
+    The usage chunk at the end of the stream (stream_options include_usage) is priced and recorded.
+    """
+    usage = None
+    for chunk in response:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+    if usage is not None:
+        _record_completion_usage(model, usage)
+
+def completion_content(client, model: str, **kwargs):
+    """
+    Yield the answer of a chat completion as text pieces.
+    Models the registry marks as streaming are streamed; the others are called once and their answer is yielded whole.
+    """
+    if get_model(model)["streaming"]:
+        response = stream_chat_completion(client, **kwargs, stream=True, stream_options={"include_usage": True})
+        yield from stream_content(response, model)
+        return
+    with request_slot():
+        response = client.chat.completions.create(**kwargs, timeout=model_timeout(model))
+    if response.usage is not None:
+        _record_completion_usage(model, response.usage)
+    if response.choices and response.choices[0].message.content:
+        yield response.choices[0].message.content
+
 # Call the llm model: chat completions endpoint: import openai
-def call_llm(context: str, prompt: str, api_key, temperature=0.1):
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature = temperature,
+def call_llm(context: str, prompt: str, api_key, temperature=0.1, context_ids=None):
+    """
+    Stream an answer from the chat model. Answers to repeated questions are replayed from the response cache;
+    context_ids (ids of the retrieved chunks in the context) also enable matching similar questions.
+    """
+    model = CHAT_MODEL
+    cache = get_response_cache()
+    embed = lambda text: get_embedding_function(api_key)([text])[0]
+    cached_response = cache.get(model, system_prompt_generic, context, prompt, temperature, context_ids, embed)
+    if cached_response is not None:
+        yield from replay_response(cached_response)
+        return
+
+    client = get_openai_client(api_key)
+    response = completion_content(client, model,
+        **completion_params(model, MAX_OUTPUT_TOKENS, temperature),
         messages=[
             {"role": "developer", "content": system_prompt_generic},
             {"role": "user", "content": f"Context: {context}\nQuestion: {prompt}"}
-        ], 
-        max_tokens=1000,
-        stream=True,
-        stream_options={"include_usage": True}
+        ]
     )
-    cost_per_output_token = 0.6/10**6 # ChatGPT 4o-mini Output tokens pricing (this is on the higher end, input tokens are cheaper 0.15/1M tokens)
-    cost_per_prompt_token = 0.15/ 10**6
-    cost_incurred = 0
     
-    full_response = ""
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            full_response += chunk.choices[0].delta.content
-            yield chunk.choices[0].delta.content
-        elif chunk.choices == []:
-            prompt_tokens_count = chunk.usage.prompt_tokens
-            completion_tokens_count = chunk.usage.completion_tokens
-            cost_incurred += completion_tokens_count * cost_per_output_token + prompt_tokens_count * cost_per_prompt_token
-            yield cost_incurred
-        else:
-            break
+    response_parts = []
+    for content in response:
+        response_parts.append(content)
+        yield content
     
-    update_user_cost(st.session_state["username"], cost_incurred)
+    full_response = "".join(response_parts)
+    if full_response:
+        cache.put(model, system_prompt_generic, context, prompt, temperature, full_response, context_ids, embed)
 
 # Reasoning LLM
 def call_reasoning_llm(context: str, prompt: str, api_key: str, temperature=0.1):
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model = "o3-mini",
+    client = get_openai_client(api_key)
+    yield from completion_content(client, REASONING_MODEL,
+        **completion_params(REASONING_MODEL, MAX_OUTPUT_TOKENS),
         messages=[
             {'role': 'developer', 'content': system_prompt_reasoning},
             {"role": "user", "content": f"Context: {context}\nQuestion: {prompt}"}
-        ],
-        max_completion_tokens=1000,
-        stream=True,
-        stream_options= {"include_usage": True}
+        ]
     )
-    
-    cost_per_output_token = 4.4/10**6 # ChatGPT 4o is one of the most advanced API Models with very high pricing. Do not use, until absolutely needed.
-    cost_per_prompt_token = 1.10
-    full_response = ""
-    cost_incurred = 0
-
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            full_response += chunk.choices[0].delta.content
-            yield chunk.choices[0].delta.content
-        elif chunk.choices == []:
-            prompt_tokens_count = chunk.usage.prompt_tokens
-            completion_tokens_count = chunk.usage.completion_tokens
-            cost_incurred += completion_tokens_count * cost_per_output_token + prompt_tokens_count * cost_per_prompt_token
-            yield cost_incurred
-        else:
-            break
-    
-    update_user_cost(st.session_state["username"], cost_incurred)
 
 # This Model is cuurently not used.
 def machine_learning_and_data_science(context: str, prompt: str, api_key: str, temperature: 0.1):
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model = "o1",
+    client = get_openai_client(api_key)
+    yield from completion_content(client, "o1",
+        **completion_params("o1", MAX_OUTPUT_TOKENS),
         messages=[
             {'role': 'developer', 'content': system_prompt_reasoning},
             {"role": "user", "content": f"Context: {context}\nQuestion: {prompt}"}
         ],
-        max_completion_tokens=1000,
         reasoning_effort="medium",
-        frequency_penalty = 1.5,
-        stream=True,
-        stream_options= {"include_usage": True}
+        frequency_penalty = 1.5
     )
     
-    cost_per_output_token = 4.4/10**6 # ChatGPT 4o is one of the most advanced API Models with very high pricing. Do not use, until absolutely needed.
-    cost_per_prompt_token = 1.10
-    full_response = ""
-    cost_incurred = 0
-
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            full_response += chunk.choices[0].delta.content
-            yield chunk.choices[0].delta.content
-        elif chunk.choices == []:
-            prompt_tokens_count = chunk.usage.prompt_tokens
-            completion_tokens_count = chunk.usage.completion_tokens
-            cost_incurred += completion_tokens_count * cost_per_output_token + prompt_tokens_count * cost_per_prompt_token
-            yield cost_incurred
-        else:
-            break
-    update_user_cost(st.session_state["username"], cost_incurred)
-    
 
 def generate_images(prompt: str, api_key: str):
     """
@@ -237,20 +237,21 @@ def generate_images(prompt: str, api_key: str):
         str: URL of the generated image
     """
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
 
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size="1024x1024"
-        )
+        with request_slot():
+            response = client.images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                timeout=model_timeout("dall-e-3")
+            )
 
         image_url = response.data[0].url
         
-        # Calculate approximate cost (DALL-E 3 1024x1024 costs about $0.04 per image)
-        cost_incurred = 0.04
-        update_user_cost(st.session_state["username"], cost_incurred)
+        # DALL-E 3 is priced per image
+        record_usage(st.session_state["username"], "dall-e-3", images=1)
         
         return image_url
     except Exception as e:
@@ -381,6 +382,10 @@ def crawl_website(base_url: str, max_depth: int = 2, delay: float = 0.5):
     return results
 
 
+# Token budgets of the crawled pages returned to an agent: in total and per page
+CRAWL_TOOL_TOKEN_BUDGET = 12000
+CRAWL_PAGE_MAX_TOKENS = 2000
+
 def web_crawler_function(query: str, max_depth: int = 2, delay: float = 0.5, num: int = 5) -> str:
     """
     Unified web crawling tool for the agent.
@@ -394,17 +399,22 @@ def web_crawler_function(query: str, max_depth: int = 2, delay: float = 0.5, num
         urls = url_pattern.findall(query)
         if urls:
             summary = f"Crawled data from {urls}:\n\n"
+            sources = []
             for url in urls:
                 data = crawl_website(url, max_depth, delay)
                 if data:
-                    for url, text in data.items():
-                        snippet = text[:8192].replace('\n', ' ')
-                        summary += f"URL: {url}\nSnippet: {snippet}...\n\n"
+                    for page_url, text in data.items():
+                        snippet = text.replace('\n', ' ')
+                        sources.append({"kind": "crawl", "label": page_url, "max_tokens": CRAWL_PAGE_MAX_TOKENS,
+                                        "text": f"URL: {page_url}\nSnippet: {snippet}"})
                     
                 else:
                     # Fallback to web search if crawling fails
                     search_results = search_web(url, num = num)
-                    summary += f"Search results from fallback for {url}:\n{search_results}\n\n"
+                    sources.append({"kind": "web", "label": url,
+                                    "text": f"Search results from fallback for {url}:\n{search_results}"})
+            # Pages are measured in tokens against one budget instead of a fixed number of characters each
+            summary += pack_context(sources, CRAWL_TOOL_TOKEN_BUDGET)[0]
         else:
             summary = "Data from internet search" + search_web(query, num=10)
         
@@ -420,8 +430,8 @@ def rerank_cross_encoders(prompt: str, documents: list[str])-> tuple[str, list[i
     relevant_text = ""
     relevant_text_ids = []
 
-    encoder_model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
-    ranks = encoder_model.rank(prompt, documents, top_k=3)
+    # Shared service: model loaded once, pairs scored in one batch, scores memoized
+    ranks = get_reranker().rank(prompt, documents, top_k=3)
     for rank in ranks:
         relevant_text += documents[rank["corpus_id"]] + "\n"
         relevant_text_ids.append(rank["corpus_id"])
@@ -430,17 +440,23 @@ def rerank_cross_encoders(prompt: str, documents: list[str])-> tuple[str, list[i
 
 # Create a context summarizer function to be used in follow up questions.
 def summarize_chunk(api_key: str, turns: list[tuple[str, str]]) -> str:
-    llm = OpenAI(api_key=api_key, temperature=0.1)
+    client = get_openai_client(api_key)
     template = """
         You are a concise summarizer. 
         Summarize the key facts and questions from this conversation chunk in less than 300 words.
         {turns}
     """
     turns_text = "\n".join(f"User: {u}\nAssistant: {a}" for u, a in turns)
-    prompt = PromptTemplate.from_template(template)
-    chain = LLMChain(llm=llm, prompt=prompt)
+    prompt = PromptTemplate.from_template(template).format(turns=turns_text)
+    with request_slot():
+        response = client.chat.completions.create(
+            **completion_params(CHAT_MODEL, MAX_OUTPUT_TOKENS, 0.1),
+            messages=[{"role": "user", "content": prompt}],
+            timeout=model_timeout(CHAT_MODEL)
+        )
+    record_usage(st.session_state["username"], CHAT_MODEL, response.usage.prompt_tokens, response.usage.completion_tokens)
 
-    return chain.run(turns=turns_text).strip()
+    return response.choices[0].message.content.strip()
 
 def get_relevant_context(prompt: str, summaries: list[str], raw_turns: list[tuple[str, str]], 
                          rerank_fn, k_summaries: int = 3, k_raw_turns: int = 2) -> str:
@@ -0,0 +1,83 @@
+# Models the app can call, keyed by the name shown in the UI.
+# Prices are USD per 1M tokens (dall-e-3: per image); windows and limits are in tokens.
+#   api_model: name sent to the API
+#   streaming: chat completions can be streamed
+#   reasoning: o-series quirks - no temperature, max_completion_tokens instead of max_tokens
+#   reasoning_effort: the reasoning_effort parameter is accepted
+#   timeout: read timeout in seconds (reasoning and image models can take minutes before the first token)
+MODEL_REGISTRY = {
+    "gpt-4o": {
+        "api_model": "gpt-4o", "context_window": 128_000, "max_output_tokens": 16_384,
+        "input_price": 2.50, "cached_input_price": 1.25, "output_price": 10.00,
+        "streaming": True, "reasoning": False, "reasoning_effort": False, "timeout": 60.0,
+    },
+    "gpt-4o-mini": {
+        "api_model": "gpt-4o-mini", "context_window": 128_000, "max_output_tokens": 16_384,
+        "input_price": 0.15, "cached_input_price": 0.075, "output_price": 0.60,
+        "streaming": True, "reasoning": False, "reasoning_effort": False, "timeout": 60.0,
+    },
+    "gpt-4.5": {
+        "api_model": "gpt-4.5-preview", "context_window": 128_000, "max_output_tokens": 16_384,
+        "input_price": 75.00, "cached_input_price": 37.50, "output_price": 150.00,
+        "streaming": True, "reasoning": False, "reasoning_effort": False, "timeout": 180.0,
+    },
+    "o1": {
+        "api_model": "o1", "context_window": 200_000, "max_output_tokens": 100_000,
+        "input_price": 15.00, "cached_input_price": 7.50, "output_price": 60.00,
+        "streaming": True, "reasoning": True, "reasoning_effort": True, "timeout": 300.0,
+    },
+    "o1-pro": {
+        "api_model": "o1-pro", "context_window": 200_000, "max_output_tokens": 100_000,
+        "input_price": 150.00, "cached_input_price": 150.00, "output_price": 600.00,
+        "streaming": False, "reasoning": True, "reasoning_effort": True, "timeout": 600.0,
+    },
+    "o1-mini": {
+        "api_model": "o1-mini", "context_window": 128_000, "max_output_tokens": 65_536,
+        "input_price": 1.10, "cached_input_price": 0.55, "output_price": 4.40,
+        "streaming": True, "reasoning": True, "reasoning_effort": False, "timeout": 180.0,
+    },
+    "o3-mini": {
+        "api_model": "o3-mini", "context_window": 200_000, "max_output_tokens": 100_000,
+        "input_price": 1.10, "cached_input_price": 0.55, "output_price": 4.40,
+        "streaming": True, "reasoning": True, "reasoning_effort": True, "timeout": 180.0,
+    },
+    "dall-e-3": {
+        "api_model": "dall-e-3", "image_price": 0.04, "streaming": False, "reasoning": False,
+        "reasoning_effort": False, "timeout": 120.0,
+    },
+}
+# Used for names the registry does not know, e.g. a model served by a local stub
+DEFAULT_MODEL = "gpt-4o-mini"
+
+_BY_API_MODEL = {model["api_model"]: model for model in MODEL_REGISTRY.values()}
+
+
+def get_model(name: str) -> dict:
+    """Registry entry of a model (UI or API name); unknown names get the default model's limits and prices"""
+    model = MODEL_REGISTRY.get(name) or _BY_API_MODEL.get(name)
+    if model is None:
+        print(f"Model '{name}' is not in the model registry, using the {DEFAULT_MODEL} settings")
+        return {**MODEL_REGISTRY[DEFAULT_MODEL], "api_model": name}
+    return model
+
+
+def completion_params(name: str, max_tokens: int, temperature: float = None) -> dict:
+    """model, output limit and temperature arguments of a chat completion, following the model's quirks"""
+    model = get_model(name)
+    max_tokens = min(max_tokens, model["max_output_tokens"])
+    if model["reasoning"]:
+        return {"model": model["api_model"], "max_completion_tokens": max_tokens}
+    params = {"model": model["api_model"], "max_tokens": max_tokens}
+    if temperature is not None:
+        params["temperature"] = temperature
+    return params
+
+
+def usage_cost(name: str, prompt_tokens: int = 0, completion_tokens: int = 0, cached_tokens: int = 0,
+               images: int = 0) -> float:
+    """USD cost of a call from its reported usage"""
+    model = get_model(name)
+    if images:
+        return images * model.get("image_price", 0.0)
+    return ((prompt_tokens - cached_tokens) * model["input_price"] + cached_tokens * model["cached_input_price"]
+            + completion_tokens * model["output_price"]) / 10**6
@@ -0,0 +1,71 @@
+import contextlib, os, threading
+import httpx
+from openai import OpenAI
+from modelregistry import get_model
+
+# One OpenAI client per (api key, base url) for the whole process, so calls reuse keep-alive connections.
+# Set OPENAI_BASE_URL to an OpenAI-compatible server (e.g. a local stub) for load tests.
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+HTTP_MAX_CONNECTIONS = 32
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY = 120
+OPENAI_MAX_RETRIES = 2
+# Requests in flight at once across all sessions; further calls wait for a slot
+MAX_CONCURRENT_REQUESTS = 16
+CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def model_timeout_seconds(model: str) -> float:
+    return get_model(model).get("timeout", DEFAULT_READ_TIMEOUT) if model else DEFAULT_READ_TIMEOUT
+
+
+def model_timeout(model: str) -> httpx.Timeout:
+    """Per-request timeout of a model: a short connect timeout and a model-specific read timeout"""
+    return httpx.Timeout(model_timeout_seconds(model), connect=CONNECT_TIMEOUT)
+
+
+def get_openai_client(api_key: str, base_url: str = None) -> OpenAI:
+    """Return the shared client for an API key, creating it and its connection pool on first use"""
+    base_url = base_url or OPENAI_BASE_URL
+    key = (api_key, base_url)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+                    timeout=httpx.Timeout(DEFAULT_READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                )
+                client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                max_retries=OPENAI_MAX_RETRIES)
+                _clients[key] = client
+    return client
+
+
+@contextlib.contextmanager
+def request_slot():
+    """Hold one of the process-wide request slots"""
+    with _request_slots:
+        yield
+
+
+def stream_chat_completion(client: OpenAI, **kwargs):
+    """
+    Streamed chat completion that holds a request slot until the stream is consumed or closed.
+    Yields the chunks of client.chat.completions.create(**kwargs), with the model's timeout unless one is given.
+    """
+    kwargs.setdefault("timeout", model_timeout(kwargs.get("model")))
+    with request_slot():
+        stream = client.chat.completions.create(**kwargs)
+        try:
+            yield from stream
+        finally:
+            stream.close()
@@ -0,0 +1,105 @@
+import hashlib, threading
+from collections import OrderedDict
+
+# Cross-encoder reranking shared by the whole process: the model is loaded once, on first use
+RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_BATCH_SIZE = 32
+RERANK_NUM_THREADS = 4
+RERANK_CACHE_SIZE = 20000
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class RerankerService:
+    """
+    Lazily loaded CrossEncoder that scores all (query, passage) pairs of a call in one batched predict.
+    Scores are memoized per (query hash, passage hash) with LRU eviction.
+    """
+    def __init__(self, model_name: str = RERANKER_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 num_threads: int = RERANK_NUM_THREADS, cache_size: int = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.cache_size = cache_size
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    import torch
+                    from sentence_transformers import CrossEncoder
+                    torch.set_num_threads(self.num_threads)
+                    self._model = CrossEncoder(self.model_name)
+        return self._model
+
+    def score(self, query: str, passages: list[str]) -> list[float]:
+        """Relevance score of every passage for the query; only uncached pairs reach the model"""
+        query_hash = _text_hash(query)
+        keys = [(query_hash, _text_hash(passage)) for passage in passages]
+        scores = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key] = self._cache[key]
+
+        missing = {}
+        for key, passage in zip(keys, passages):
+            if key not in scores and key not in missing:
+                missing[key] = passage
+        if missing:
+            predictions = self._get_model().predict(
+                [(query, passage) for passage in missing.values()],
+                batch_size=self.batch_size, show_progress_bar=False
+            )
+            with self._cache_lock:
+                for key, prediction in zip(missing, predictions):
+                    scores[key] = float(prediction)
+                    self._cache[key] = scores[key]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [scores[key] for key in keys]
+
+    def rank(self, query: str, passages: list[str], top_k: int = 3) -> list[dict]:
+        """Same output layout as CrossEncoder.rank: dicts with "corpus_id" and "score", best first"""
+        scores = self.score(query, passages)
+        order = sorted(range(len(passages)), key=lambda i: -scores[i])[:top_k]
+        return [{"corpus_id": i, "score": scores[i]} for i in order]
+
+    def rerank_results(self, query: str, results: dict, top_k: int = 5) -> dict:
+        """Reorder a query_collection result by cross-encoder score and keep the top_k entries"""
+        documents = (results.get("documents") or [[]])[0]
+        if "ids" not in results or not documents:
+            return results
+        ranks = self.rank(query, documents, top_k)
+        reranked = {
+            field: [[values[0][rank["corpus_id"]] for rank in ranks]]
+            for field, values in results.items() if values and len(values[0]) == len(documents)
+        }
+        reranked["rerank_scores"] = [[rank["score"] for rank in ranks]]
+        return reranked
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_reranker() -> RerankerService:
+    """Return the process-wide reranker service"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RerankerService()
+    return _service
+
+
+def rerank_results(query: str, results: dict, top_k: int = 5) -> dict:
+    """Reranking stage to run after vectordb.query_collection"""
+    return get_reranker().rerank_results(query, results, top_k)
@@ -0,0 +1,139 @@
+import hashlib, threading, time
+from collections import OrderedDict
+import numpy as np
+
+# Completed LLM answers, reused for repeated questions over the same context
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+# Cosine similarity of prompt embeddings above which a cached answer to the same retrieved chunks is reused
+SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+# Temperatures are compared rounded to this step
+TEMPERATURE_BUCKET = 0.1
+# Cached answers are replayed in pieces of this many characters
+REPLAY_CHUNK_CHARS = 40
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier response cache with TTL and LRU eviction.
+    Exact tier: (model, system prompt, context, prompt, temperature bucket).
+    Semantic tier: same model, system prompt, temperature bucket and retrieved context ids,
+    with a prompt embedding above the similarity threshold.
+    """
+    def __init__(self, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 similarity_threshold: float = SEMANTIC_SIMILARITY_THRESHOLD):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # exact key -> {"response", "expires_at", "group", "embedding"}
+        self._groups: dict = {}        # group key -> set of exact keys
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(model: str, system_prompt: str, context: str, prompt: str, temperature: float, context_ids):
+        bucket = round(round(temperature / TEMPERATURE_BUCKET) * TEMPERATURE_BUCKET, 2)
+        base = f"{model}\0{_hash(system_prompt)}\0{bucket}"
+        exact = _hash(f"{base}\0{_hash(context)}\0{prompt}")
+        group = _hash(f"{base}\0" + "\0".join(context_ids)) if context_ids else None
+        return exact, group
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        if entry["group"] is not None:
+            members = self._groups.get(entry["group"])
+            members.discard(key)
+            if not members:
+                del self._groups[entry["group"]]
+
+    def get(self, model: str, system_prompt: str, context: str, prompt: str, temperature: float,
+            context_ids=None, embed=None):
+        """
+        Cached answer or None. embed(text) -> vector is only called when the semantic tier has candidates.
+        """
+        exact, group = self._keys(model, system_prompt, context, prompt, temperature, context_ids)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(exact)
+            if entry is not None and entry["expires_at"] > now:
+                self._entries.move_to_end(exact)
+                self.hits += 1
+                return entry["response"]
+            candidates = [key for key in self._groups.get(group, ())
+                          if self._entries[key]["expires_at"] > now and self._entries[key]["embedding"] is not None]
+            if not candidates or embed is None:
+                self.misses += 1
+                return None
+            matrix = np.stack([self._entries[key]["embedding"] for key in candidates])
+
+        try:
+            query = np.array(embed(prompt), dtype=np.float32)
+        except Exception as e:
+            print(f"Error embedding prompt for the response cache: {e}")
+            query = None
+        with self._lock:
+            if query is not None and np.linalg.norm(query) > 0:
+                similarities = matrix @ (query / np.linalg.norm(query))
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold and candidates[best] in self._entries:
+                    self._entries.move_to_end(candidates[best])
+                    self.semantic_hits += 1
+                    return self._entries[candidates[best]]["response"]
+            self.misses += 1
+        return None
+
+    def put(self, model: str, system_prompt: str, context: str, prompt: str, temperature: float, response: str,
+            context_ids=None, embed=None):
+        """Store a completed answer; it joins the semantic tier when context ids and an embedder are given"""
+        exact, group = self._keys(model, system_prompt, context, prompt, temperature, context_ids)
+        embedding = None
+        if group is not None and embed is not None:
+            try:
+                embedding = np.array(embed(prompt), dtype=np.float32)
+                norm = np.linalg.norm(embedding)
+                embedding = embedding / norm if norm > 0 else None
+            except Exception as e:
+                print(f"Error embedding prompt for the response cache: {e}")
+        now = time.time()
+        with self._lock:
+            if exact in self._entries:
+                self._remove(exact)
+            self._entries[exact] = {"response": response, "expires_at": now + self.ttl_seconds,
+                                    "group": group if embedding is not None else None, "embedding": embedding}
+            if embedding is not None:
+                self._groups.setdefault(group, set()).add(exact)
+            # Expired entries first, then the least recently used ones
+            for key in [key for key, entry in self._entries.items() if entry["expires_at"] <= now]:
+                self._remove(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses,
+                "entries": len(self._entries)}
+
+
+def replay_response(response: str, chunk_chars: int = REPLAY_CHUNK_CHARS):
+    """Yield a cached answer in pieces, like a streamed completion"""
+    for start in range(0, len(response), chunk_chars):
+        yield response[start:start + chunk_chars]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
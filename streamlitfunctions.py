@@ -1,28 +1,46 @@
 import re
 import streamlit as st
-from chatFunctions import save_chat_sessions, delete_chat
-from llms import call_llm, call_reasoning_llm, search_web, crawl_website, generate_images
+import chatstore
+from chatFunctions import save_chat_message, delete_chat
+from llms import (
+    call_llm, call_reasoning_llm, search_web, crawl_website, generate_images,
+    system_prompt_generic, system_prompt_reasoning, CHAT_MODEL, REASONING_MODEL, MAX_OUTPUT_TOKENS
+)
+from contextpacker import context_budget, pack_context
 from styles import get_latex_styles
+from streamrenderer import MarkdownStreamRenderer
 from fileprocessing import process_document
 from vectordb import query_collection
+from ingestjobs import get_jobs, cancel_job, ACTIVE_STATUSES
 
 # Get the API Key
 api_key = st.secrets["api_keys"]["openai"]
 
+# Tokens of a crawled page that may go into the context
+CRAWL_PAGE_CONTEXT_TOKENS = 500
+# Seconds between refreshes of the indexing progress while a job is queued or running
+INGEST_POLL_SECONDS = 1
+
+
+def knowledge_base_sources(results):
+    """Context sources (see contextpacker.pack_context) of a query_collection result, in retrieval order"""
+    if "ids" not in results:
+        return []
+    return [{"kind": "knowledge_base", "id": chunk_id, "label": chunk_id, "text": document}
+            for chunk_id, document in zip(results["ids"][0], results["documents"][0])]
+
 
 def get_reasoning_context(prompt):
     """
-    Generate additional context for the reasoning model.
-    If the prompt includes an uploaded document, summarize its contents.
-    Otherwise, use the prompt text combined with the vector collection context.
+    Generate additional context sources for the reasoning model.
+    If the prompt includes an uploaded document, its summary comes first.
+    The vector collection results follow.
     """
     # Extract text prompt
     prompt_text = prompt.get("text") if isinstance(prompt, dict) else prompt
     
     # Query the vector store for additional context
-    results = query_collection(prompt_text, api_key)
-    documents = results.get("documents")
-    vector_context = "\n\n".join(documents[0]) if documents and len(documents) > 0 and documents[0] else ""
+    sources = knowledge_base_sources(query_collection(prompt_text, api_key))
     
     # Check if there's an uploaded file in the prompt (if prompt is a dict)
     if isinstance(prompt, dict) and prompt.get("files"):
@@ -33,13 +51,8 @@ def get_reasoning_context(prompt):
         doc_text = "\n".join([doc.page_content for doc in all_splits])
         # Summarize the document text
         summary = summarize_text(doc_text, api_key)
-        return f"Document Summary:\n{summary}\n\nAdditional Context:\n{vector_context}"
-    else:
-        # If no file was uploaded, use vector store context
-        if vector_context:
-            return f"Knowledge Base Information:\n{vector_context}"
-        else:
-            return "No additional context found in knowledge base."
+        sources.insert(0, {"kind": "upload", "label": uploaded_file.name, "text": f"Document Summary:\n{summary}"})
+    return sources
 
 def summarize_text(context: str, api_key: str):
     """
@@ -48,7 +61,10 @@ def summarize_text(context: str, api_key: str):
     """
     # Ensure the text is not excessively long for a summary placeholder.
     prompt = "Create a summary of the document in 1000 words or less"
-    summary = call_llm(context= context, prompt= prompt, api_key=api_key, temperature=1.0)
+    # Large documents are cut to the model's input budget (whole sentences, from the start)
+    budget = context_budget(CHAT_MODEL, system_prompt_generic + prompt, MAX_OUTPUT_TOKENS)
+    context, _ = pack_context([{"kind": "upload", "label": "document", "text": context}], budget)
+    summary = "".join(call_llm(context= context, prompt= prompt, api_key=api_key, temperature=1.0))
     summary = summary[:1000] + "..." if len(summary) > 1000 else summary
     return summary
 
@@ -67,6 +83,11 @@ def query_and_display_response(prompt, reasoning=False, search=False, images=Fal
     
     # Default context
     context = "No relevant information found in the knowledge base."
+    # Context sources gathered below, packed into the model's input budget before the call
+    sources = []
+    context_prefix = ""
+    # Ids of the retrieved chunks when the context is exactly the knowledge base results (enables similar-question reuse)
+    context_ids = None
     
     # Check if the prompt contains URLs for crawling
     url_pattern = re.compile(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+')
@@ -79,38 +100,46 @@ def query_and_display_response(prompt, reasoning=False, search=False, images=Fal
     elif urls and len(urls) > 0 and search:
         spinner_placeholder.info(f"Crawling website(s): {urls[0]}...")
         crawl_results = crawl_website(urls[0], max_depth=1)
-        if crawl_results:
-            crawled_context = "\n\n".join([f"From {url}: {content[:2000]}..." for url, content in crawl_results.items()])
-            context = crawled_context
+        sources = [{"kind": "crawl", "label": url, "text": f"From {url}: {content}", "max_tokens": CRAWL_PAGE_CONTEXT_TOKENS}
+                   for url, content in crawl_results.items()]
     # Handle search if search is enabled and no url found in prompt
     elif not (urls and len(urls) > 0) and (context == "No relevant information found in the knowledge base" or search) and not images:
         spinner_placeholder.info("Shopping from Google...")
         web_context = search_web(query=prompt, num=10)
         if web_context and "No external search results found" not in web_context:
-            # Combine vector store results with web search if both are available
-            if context != "No relevant information found in the knowledge base.":
-                context = f"{context}\n\nAdditional information from web:\n{web_context}"
-            else:
-                context = web_context
+            sources = [{"kind": "web", "label": "web search", "text": web_context}]
     # Handle URL found but search not enabled
     elif urls and len(urls) > 0 and not search:
         context = "URLs found in the prompt, but search is not enabled."
     # Handle reasoning with vector store context
     elif reasoning:
         spinner_placeholder.info("Building reasoning context...")
-        knowledge_base = get_reasoning_context(prompt)
-        context = prompt + "\n\n" + knowledge_base
+        sources = get_reasoning_context(prompt)
+        context_prefix = prompt + "\n\n"
     # Otherwise query vector store for regular queries
     else:
         # Query vector store
         results = query_collection(prompt, api_key)
-        documents = results.get("documents")
-        context_list = documents[0] if documents and len(documents) > 0 and documents[0] else []
+        kb_sources = knowledge_base_sources(results)
         
-        if context_list and len(context_list) > 0:
-            combined_context = "\n\n".join(context_list)
+        if kb_sources:
+            combined_context = "\n\n".join(source["text"] for source in kb_sources)
             if "insufficient information" not in combined_context.lower() and "does not contain any information" not in combined_context.lower():
-                context = combined_context
+                sources = kb_sources
+
+    # Fit the sources into the model's input budget, leaving room for the prompts and the answer
+    if sources:
+        model = REASONING_MODEL if reasoning else CHAT_MODEL
+        system_prompt = system_prompt_reasoning if reasoning else system_prompt_generic
+        budget = context_budget(model, system_prompt + context_prefix + prompt, MAX_OUTPUT_TOKENS)
+        packed_context, kept = pack_context(sources, budget)
+        if packed_context:
+            context = context_prefix + packed_context
+        if not reasoning and kept and len(kept) == len(sources) and \
+                all(source["kind"] == "knowledge_base" and not source["truncated"] for source in kept):
+            context_ids = [source["id"] for source in kept]
+    elif context_prefix:
+        context = context_prefix + "No additional context found in knowledge base."
     
     # Add LaTeX styles to enable proper formula rendering
     st.markdown(get_latex_styles(), unsafe_allow_html=True)
@@ -132,34 +161,29 @@ def query_and_display_response(prompt, reasoning=False, search=False, images=Fal
                 message_placeholder.error(full_response)
         # Handle text response with appropriate LLM
         else:
-            full_response = ""
             # Choose the right LLM based on reasoning flag
             llm_func = call_reasoning_llm if reasoning else call_llm
+            llm_kwargs = {} if reasoning else {"context_ids": context_ids}
             spinner_placeholder.info("Cooking your response...")
             
-            # Process LaTeX in response during streaming
-            for response_chunk in llm_func(context=context, prompt=prompt, api_key=api_key, temperature=st.session_state.temperature):
-                full_response += response_chunk
-                # Use a different approach for displaying the streaming content
-                message_placeholder.markdown(full_response + "| ", unsafe_allow_html=True)
+            # Redraw in frames rather than per token; open code fences and LaTeX blocks are not re-parsed half-written
+            renderer = MarkdownStreamRenderer(message_placeholder)
+            for response_chunk in llm_func(context=context, prompt=prompt, api_key=api_key, temperature=st.session_state.temperature, **llm_kwargs):
+                renderer.add(response_chunk)
             
             # Extra processing for reasoning model to ensure markdown works correctly
             if reasoning:
                 # Clear the placeholder first
                 message_placeholder.empty()
-                # Then render the full response with unsafe_allow_html set to True
-                message_placeholder.markdown(full_response, unsafe_allow_html=True)
-            else:
-                # Format final response for regular LLM
-                message_placeholder.markdown(full_response, unsafe_allow_html=True)
+            # Render the full response once with unsafe_allow_html set to True
+            full_response = renderer.finish()
         
         # Save chat message
         if "current_chat_id" in st.session_state and st.session_state.chat_sessions:
             current_chat = next((chat for chat in st.session_state.chat_sessions if chat["chat_id"] == st.session_state.current_chat_id), None)
             if current_chat:
-                current_chat["messages"].append({"question": prompt, "answer": full_response})
                 username = st.session_state.get("username", "guest")
-                save_chat_sessions(st.session_state.chat_sessions, username)
+                save_chat_message(current_chat, prompt, full_response, username)
                 
     spinner_placeholder.empty()
 
@@ -179,9 +203,48 @@ def handle_chat_button(chat, is_active, button_label, update_favorite):
     with col2:
         if st.button(button_label, key=f"fav_{chat_id}"):
             chat["favorite"] = update_favorite
-            save_chat_sessions(st.session_state.chat_sessions, st.session_state.username)
+            chatstore.save_chat(st.session_state.username, chat)
             st.rerun()
     
     with col3:
         if st.button("🗑️", key=f"del_{chat_id}"):
             delete_chat(chat_id)
+
+
+def show_ingestion_jobs(username, chat_id) -> bool:
+    """
+    Show the indexing jobs of the current chat and the outcome of the latest one.
+    Progress is polled without rerunning the whole page, and only while a job is queued or running.
+    Returns whether the jobs are being polled.
+    """
+    polling = bool(get_jobs(username, chat_id, active_only=True))
+    run_every = INGEST_POLL_SECONDS if polling else None
+    st.fragment(_ingestion_jobs_fragment, run_every=run_every)(username, chat_id, polling)
+    return polling
+
+
+def _ingestion_jobs_fragment(username, chat_id, polling):
+    jobs = get_jobs(username, chat_id)
+    active_jobs = [job for job in jobs if job["status"] in ACTIVE_STATUSES]
+    if polling and not active_jobs:
+        # The last job finished: rerun the page so the fragment stops polling, and report the outcome there
+        st.rerun()
+    for job in active_jobs:
+        col1, col2 = st.columns([6, 1])
+        with col1:
+            status_text = f"Indexing '{job['file_name']}': {job['chunks_done']} chunks" if job["status"] == "running" \
+                else f"'{job['file_name']}' is queued for indexing"
+            st.progress(job["progress"], text=status_text)
+        with col2:
+            if st.button("Cancel", key=f"cancel_job_{job['job_id']}"):
+                cancel_job(job["job_id"])
+    if not active_jobs and jobs and jobs[0]["updated_at"] > st.session_state.get("jobs_seen_at", 0):
+        # Report the outcome of the latest job once
+        latest = jobs[0]
+        if latest["status"] == "done":
+            st.success(f"✅ File '{latest['file_name']}' processed and added to temporary knowledge base!")
+        elif latest["status"] == "failed":
+            st.error(f"Error processing file '{latest['file_name']}': {latest['error']}")
+        elif latest["status"] == "cancelled":
+            st.warning(f"Indexing of '{latest['file_name']}' was cancelled.")
+        st.session_state.jobs_seen_at = latest["updated_at"]
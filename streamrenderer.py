@@ -0,0 +1,107 @@
+import time
+
+# Streamed answers are redrawn at most once per frame: after this many seconds or characters
+STREAM_FRAME_SECONDS = 0.05
+STREAM_FRAME_CHARS = 40
+STREAM_CURSOR = "| "
+
+
+def _fence_marker(stripped_line: str) -> str:
+    """The ``` or ~~~ run that opens or closes a code fence on this line, or an empty string"""
+    if not stripped_line.startswith(("```", "~~~")):
+        return ""
+    return stripped_line[:len(stripped_line) - len(stripped_line.lstrip(stripped_line[0]))]
+
+
+def split_complete_blocks(text: str) -> tuple[list[str], str, str, int]:
+    """
+    Split markdown into finished blocks and the block still being written.
+    A block ends at a blank line outside code fences and $$ math blocks.
+    A fence is only closed by a bare run of its own character at least as long as the one that opened it.
+
+    Returns:
+        (finished blocks, unfinished rest, the marker of the code fence the rest ends inside or "",
+         offset in the rest where an unclosed $$ block starts or -1)
+    """
+    blocks = []
+    block_start = 0
+    position = 0
+    fence = ""
+    math_start = -1
+    for line in text.splitlines(keepends=True):
+        if not line.endswith("\n"):
+            break  # the last line is still being written
+        stripped = line.strip()
+        marker = _fence_marker(stripped)
+        if marker and not fence:
+            fence = marker
+        elif fence:
+            if marker and marker[0] == fence[0] and len(marker) >= len(fence) and stripped == marker:
+                fence = ""
+        elif stripped.count("$$") % 2 == 1:
+            math_start = -1 if math_start >= 0 else position
+        position += len(line)
+        if not stripped and not fence and math_start < 0 and position - len(line) > block_start:
+            blocks.append(text[block_start:position])
+            block_start = position
+    rest = text[block_start:]
+    return blocks, rest, fence, (math_start - block_start if math_start >= 0 else -1)
+
+
+class MarkdownStreamRenderer:
+    """
+    Renders a streamed markdown answer into a Streamlit placeholder in frames instead of on every delta.
+    Finished blocks are written once as their own elements; only the block being written is redrawn.
+    An open code fence is shown closed with its own marker, and an open $$ block is held back until it is complete.
+    """
+    def __init__(self, placeholder, frame_seconds: float = STREAM_FRAME_SECONDS,
+                 frame_chars: int = STREAM_FRAME_CHARS, cursor: str = STREAM_CURSOR):
+        self.placeholder = placeholder
+        self.frame_seconds = frame_seconds
+        self.frame_chars = frame_chars
+        self.cursor = cursor
+        self._parts = []          # deltas since the last frame
+        self._pending_chars = 0
+        self._all_parts = []      # every delta, joined once at the end
+        self._tail = ""           # text of the unfinished block
+        self._last_frame = 0.0
+        self._container = None
+        self._tail_placeholder = None
+
+    def add(self, delta: str):
+        self._parts.append(delta)
+        self._all_parts.append(delta)
+        self._pending_chars += len(delta)
+        if self._pending_chars >= self.frame_chars or time.monotonic() - self._last_frame >= self.frame_seconds:
+            self._render_frame()
+
+    def _render_frame(self):
+        if self._container is None:
+            self._container = self.placeholder.container()
+            self._tail_placeholder = self._container.empty()
+        self._tail += "".join(self._parts)
+        self._parts.clear()
+        self._pending_chars = 0
+        self._last_frame = time.monotonic()
+
+        blocks, self._tail, fence, math_start = split_complete_blocks(self._tail)
+        for block in blocks:
+            # A finished block takes the current slot for good; the unfinished one moves below it
+            self._tail_placeholder.markdown(block, unsafe_allow_html=True)
+            self._tail_placeholder = self._container.empty()
+
+        visible = self._tail if math_start < 0 else self._tail[:math_start]
+        if fence:
+            visible += self.cursor + "\n" + fence
+        else:
+            visible += self.cursor
+        self._tail_placeholder.markdown(visible, unsafe_allow_html=True)
+
+    def text(self) -> str:
+        return "".join(self._all_parts)
+
+    def finish(self) -> str:
+        """Draw the complete answer as one markdown element and return it"""
+        full_text = self.text()
+        self.placeholder.markdown(full_text, unsafe_allow_html=True)
+        return full_text
@@ -0,0 +1,21 @@
+import functools
+import tiktoken
+
+# Encoding used when a model is unknown to tiktoken; matches text-embedding-3-small
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = None) -> tiktoken.Encoding:
+    """Return the tiktoken encoding of a model, loaded once per process"""
+    if model:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Number of tokens of text for the given model (special tokens are counted as plain text)"""
+    return len(get_encoding(model).encode(text, disallowed_special=()))
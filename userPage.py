@@ -2,10 +2,11 @@ import streamlit as st
 import time
 from streamlit_extras.stylable_container import stylable_container
 from streamlit_extras.floating_button import floating_button
-from fileprocessing import process_document
-from vectordb import add_to_collection
-from chatFunctions import save_chat_sessions, load_chat_sessions, new_chat_id
-from streamlitfunctions import handle_chat_button, query_and_display_response
+from fileprocessing import file_content_hash, SUPPORTED_EXTENSIONS, ARCHIVE_EXTENSIONS
+from vectordb import get_temp_store, is_file_indexed
+from ingestjobs import submit_ingest_job
+from chatFunctions import load_chat_sessions, load_chat_messages, new_chat_id, sidebar_chat_index, search_chat_history
+from streamlitfunctions import handle_chat_button, query_and_display_response, show_ingestion_jobs
 from chatFunctions import append_message_to_current_chat
 from uservalidate import get_user_cost
 from datetime import datetime
@@ -21,6 +22,7 @@ from styles import (
     get_latex_styles
 )
 from agents import (
+    record_crew_usage,
     software_development,
     generic_agent_Setup,
     Nuclear_research,
@@ -31,6 +33,43 @@ from agents import (
 # Get the API Key
 api_key = st.secrets["api_keys"]["openai"]
 
+# Chats shown per sidebar section and turns shown per chat before "show more" buttons
+SIDEBAR_PAGE_SIZE = 20
+MESSAGE_WINDOW = 20
+
+
+def show_chat_list(chats, section, button_label, update_favorite):
+    """Render the first page(s) of a sidebar section; more chats are rendered on demand"""
+    limit_key = f"sidebar_limit_{section}"
+    limit = st.session_state.setdefault(limit_key, SIDEBAR_PAGE_SIZE)
+    for chat in chats[:limit]:
+        is_active = st.session_state.current_chat_id == chat["chat_id"]
+        handle_chat_button(chat, is_active, button_label, update_favorite)
+    if len(chats) > limit:
+        if st.button(f"Show more ({len(chats) - limit})", key=f"more_{section}"):
+            st.session_state[limit_key] = limit + SIDEBAR_PAGE_SIZE
+            st.rerun()
+
+def show_chat_search(username):
+    """Search box over the user's chat history; a result opens its chat with the matching turn in view"""
+    query = st.text_input("Search chats", key="chat_search", placeholder="Search chats", label_visibility="collapsed")
+    if not query.strip():
+        return
+    results = search_chat_history(query, username)
+    if not results:
+        st.caption("No matching messages")
+    for result in results:
+        label = f"{result['title']}: {result['snippet']}"
+        if st.button(label, key=f"search_{result['chat_id']}_{result['position']}", type="tertiary"):
+            chat = next((chat for chat in st.session_state.chat_sessions if chat["chat_id"] == result["chat_id"]), None)
+            if chat:
+                st.session_state.current_chat_id = chat["chat_id"]
+                messages = load_chat_messages(chat)
+                window_key = f"message_window_{chat['chat_id']}"
+                st.session_state[window_key] = max(st.session_state.get(window_key, MESSAGE_WINDOW),
+                                                   len(messages) - result["position"])
+                st.rerun()
+
 def user_page(username):
     """User chat interface page"""
 
@@ -61,7 +100,6 @@ def user_page(username):
     # Create a new chat if none exist
     if not st.session_state.chat_sessions:
         st.session_state.current_chat_id = new_chat_id()
-        save_chat_sessions(st.session_state.chat_sessions, username)
         
     # Set current chat if not set
     elif "current_chat_id" not in st.session_state:
@@ -102,27 +140,21 @@ def user_page(username):
         if st.button("➕ New Chat", key="new_chat_button"):
             new_id = new_chat_id()
             st.session_state.current_chat_id = new_id
-            save_chat_sessions(st.session_state.chat_sessions, username)
             st.rerun()
+
+        show_chat_search(username)
         
         
         # Organize Favorites and Old Chats
-        favorites = [chat for chat in st.session_state.chat_sessions if chat.get("favorite", False)]
-        old_chats = [chat for chat in st.session_state.chat_sessions if not chat.get("favorite", False)]
-        favorites = sorted(favorites, key = lambda x: -st.session_state.chat_sessions.index(x))
-        old_chats = sorted(old_chats, key = lambda x: -st.session_state.chat_sessions.index(x))
+        favorites, old_chats = sidebar_chat_index(st.session_state.chat_sessions)
 
         if favorites:
             st.subheader("Favorites")
-            for chat in favorites:
-                is_active = st.session_state.current_chat_id == chat["chat_id"]
-                handle_chat_button(chat, is_active, "★", False)
+            show_chat_list(favorites, "favorites", "★", False)
 
         if old_chats:
             st.subheader("Old Chats")
-            for chat in old_chats:
-                is_active = st.session_state.current_chat_id == chat["chat_id"]
-                handle_chat_button(chat, is_active, "☆", True)
+            show_chat_list(old_chats, "old_chats", "☆", True)
 
     # Main chat area
     st.markdown(get_main_section_styles(), unsafe_allow_html=True)
@@ -138,12 +170,23 @@ def user_page(username):
         if chat["chat_id"] == st.session_state.current_chat_id), None)
 
         if current_chat:
-            for message in current_chat["messages"]:
+            # Only the latest turns are rendered; older ones are added on demand
+            messages = load_chat_messages(current_chat)
+            window_key = f"message_window_{current_chat['chat_id']}"
+            window = st.session_state.setdefault(window_key, MESSAGE_WINDOW)
+            if len(messages) > window:
+                if st.button(f"Load earlier messages ({len(messages) - window})", key="load_earlier_messages"):
+                    st.session_state[window_key] = window + MESSAGE_WINDOW
+                    st.rerun()
+            for message in messages[-window:]:
                 st.chat_message("user").markdown(message["question"])
                 st.chat_message("assistant").markdown(message["answer"], unsafe_allow_html=True)
         else:
             st.write("")
 
+        # Progress of documents still being indexed for this chat, or the outcome of the last one
+        jobs_polling = show_ingestion_jobs(username, st.session_state.current_chat_id)
+
     # Place the custom buttons in your layout
     with stylable_container(
         key="bottomContent", 
@@ -151,7 +194,7 @@ def user_page(username):
         ):
         
         prompt = st.chat_input("How may I help you?", key="inputPrompt",
-            accept_file=True, file_type=["pdf", "docx", "text", "csv", "xls", "xlsx", "xlsm"], 
+            accept_file=True, file_type=SUPPORTED_EXTENSIONS + ARCHIVE_EXTENSIONS, 
             disabled=False)
 
         search_type = "primary" if st.session_state.search else "secondary"
@@ -219,18 +262,19 @@ def user_page(username):
                     str.maketrans({"-": "_", ".": "_", " ": "_"})
                 )
                 
-                # Process the document and split it into chunks
-                all_splits, file_size_bytes = process_document(uploaded_file)
-                
-                if all_splits and file_size_bytes > 0:
-                    # Setup user-specific vector store
-                    chat_id = st.session_state.current_chat_id
-                    store_path = f"rag_chroma_temp_{username}_{chat_id}"
-                    collection_name = f"sca_rag_temp_{username}_{chat_id}"
-                    
-                    # Add document chunks to vector store collection
-                    add_to_collection(all_splits, normalize_uploaded_file_name, file_size_bytes, api_key, store_path, collection_name)
-                    st.success(f"✅ File '{uploaded_file.name}' processed and added to temporary knowledge base!")
+                # Setup user-specific vector store
+                chat_id = st.session_state.current_chat_id
+                store_path, collection_name = get_temp_store(username, chat_id)
+
+                # Index the document in the background; progress is polled by show_ingestion_jobs
+                file_hash = file_content_hash(uploaded_file)
+                if is_file_indexed(store_path, collection_name, normalize_uploaded_file_name, file_hash):
+                    st.info(f"File '{uploaded_file.name}' is already in the temporary knowledge base.")
+                else:
+                    submit_ingest_job(uploaded_file, username, chat_id, normalize_uploaded_file_name,
+                                      store_path, collection_name, file_hash)
+                    if not jobs_polling:
+                        show_ingestion_jobs(username, chat_id)
             
             # Apply LaTeX styles for proper rendering
             st.markdown(get_latex_styles(), unsafe_allow_html=True)
@@ -278,6 +322,7 @@ def user_page(username):
                 # Execute the agent crew
                 try:
                     crew_output = crew.kickoff()
+                    record_crew_usage(username, model_to_use, crew_output)
                     
                     # Convert CrewOutput to string to make it JSON serializable
                     if hasattr(crew_output, "raw"):
@@ -5,61 +5,258 @@ import pysqlite3 as sqlite3
 import sys
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
-# Create Users first
-# Create Users.db if not exists already: import sqlite3
-def create_users_table():
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    query = """
+import atexit, secrets, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dbconnection import get_connection
+from modelregistry import usage_cost
+
+USERS_DB_PATH = "users.db"
+# bcrypt cost factor for new hashes; stored hashes with another factor are rehashed at the next login
+BCRYPT_ROUNDS = 12
+HASH_MAX_WORKERS = 2
+# Failed logins allowed per username / client IP within the window
+LOGIN_MAX_FAILURES_PER_USER = 5
+LOGIN_MAX_FAILURES_PER_IP = 20
+LOGIN_WINDOW_SECONDS = 300
+SESSION_TTL_SECONDS = 8 * 3600
+# Stale failure entries and expired sessions are swept at most this often, on the next failure / new session
+SWEEP_INTERVAL_SECONDS = 60
+# Usage records are buffered and written in one transaction per batch
+LEDGER_FLUSH_SIZE = 20
+LEDGER_FLUSH_SECONDS = 10
+
+_pending_usage = []  # (username, model, prompt_tokens, completion_tokens, cost, created_at)
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_MAX_WORKERS, thread_name_prefix="bcrypt")
+_failures = {}  # ("user" | "ip", value) -> deque of failure timestamps
+_failures_lock = threading.Lock()
+_last_failure_sweep = 0.0
+_sessions = {}  # token -> (username, expires_at)
+_sessions_lock = threading.Lock()
+_last_session_sweep = 0.0
+
+
+class LoginRateLimited(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many failed login attempts, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def _setup(conn):
+    conn.executescript("""
         create table if not exists users (
             id integer primary key autoincrement,
             username text unique not null,
             password text not null,
-            total_cost REAL DEFAULT 0)
-    """
-    c.execute(query)
-    conn.commit()
-    conn.close()
+            total_cost REAL DEFAULT 0);
+        create table if not exists usage_ledger (
+            id integer primary key autoincrement,
+            username text not null,
+            model text,
+            prompt_tokens integer not null default 0,
+            completion_tokens integer not null default 0,
+            cost real not null,
+            created_at real not null);
+        create table if not exists monthly_costs (
+            username text not null,
+            month text not null,
+            cost real not null default 0,
+            prompt_tokens integer not null default 0,
+            completion_tokens integer not null default 0,
+            primary key (username, month));
+    """)
+
+
+def _connect():
+    return get_connection(USERS_DB_PATH, _setup)
+
+
+def _month(timestamp: float) -> str:
+    return time.strftime("%Y-%m", time.localtime(timestamp))
+
+
+def _hash_password(password: str) -> bytes:
+    """bcrypt hash computed on the bounded hashing pool"""
+    return _hash_executor.submit(
+        lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    ).result()
+
+
+def _check_password(password: str, hashed_password: bytes) -> bool:
+    return _hash_executor.submit(bcrypt.checkpw, password.encode('utf-8'), hashed_password).result()
+
+
+def _hash_rounds(hashed_password: bytes) -> int:
+    # Layout: $2b$<rounds>$<salt+hash>
+    try:
+        return int(hashed_password.split(b"$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _failure_keys(username, ip):
+    keys = [(("user", username), LOGIN_MAX_FAILURES_PER_USER)]
+    if ip:
+        keys.append((("ip", ip), LOGIN_MAX_FAILURES_PER_IP))
+    return keys
+
+
+def _check_login_rate(username, ip):
+    now = time.time()
+    with _failures_lock:
+        for key, limit in _failure_keys(username, ip):
+            failures = _failures.get(key)
+            if not failures:
+                continue
+            while failures and failures[0] <= now - LOGIN_WINDOW_SECONDS:
+                failures.popleft()
+            if not failures:
+                del _failures[key]
+            elif len(failures) >= limit:
+                raise LoginRateLimited(int(failures[0] + LOGIN_WINDOW_SECONDS - now) + 1)
+
+
+def _record_login_failure(username, ip):
+    global _last_failure_sweep
+    now = time.time()
+    with _failures_lock:
+        if now - _last_failure_sweep >= SWEEP_INTERVAL_SECONDS:
+            # Drop the entries of users and IPs whose failures all left the window
+            for key in [key for key, failures in _failures.items()
+                        if not failures or failures[-1] <= now - LOGIN_WINDOW_SECONDS]:
+                del _failures[key]
+            _last_failure_sweep = now
+        for key, _ in _failure_keys(username, ip):
+            _failures.setdefault(key, deque()).append(now)
+
+# Create Users first
+# Create Users.db if not exists already: import sqlite3
+def create_users_table():
+    with _connect():
+        pass
 
 # Add new user to the SQLite database: import sqlite3
 def add_user(username, password):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed_password = _hash_password(password)
 
     try:
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-        conn.commit()
+        with _connect() as conn, conn:
+            conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
         print("User added successfully!")
     except sqlite3.IntegrityError:
         print("Username already exists!")
-    conn.close()
-
-def update_user_cost(username, cost):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("UPDATE users SET total_cost = total_cost + ? WHERE username = ?", (cost, username))
-    conn.commit()
-    conn.close()
-
-def get_user_cost(username):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT total_cost FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 0.0
+
+def flush_usage():
+    """Write buffered usage records to the ledger and fold them into the monthly and lifetime totals"""
+    global _last_flush
+    with _pending_lock:
+        entries = _pending_usage[:]
+        _pending_usage.clear()
+        _last_flush = time.time()
+    if not entries:
+        return
+    try:
+        with _connect() as conn, conn:
+            conn.executemany(
+                """INSERT INTO usage_ledger (username, model, prompt_tokens, completion_tokens, cost, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""", entries
+            )
+            conn.executemany(
+                """INSERT INTO monthly_costs (username, month, cost, prompt_tokens, completion_tokens) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (username, month) DO UPDATE SET cost = cost + excluded.cost,
+                   prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                   completion_tokens = completion_tokens + excluded.completion_tokens""",
+                [(username, _month(created_at), cost, prompt_tokens, completion_tokens)
+                 for username, _, prompt_tokens, completion_tokens, cost, created_at in entries]
+            )
+            conn.executemany("UPDATE users SET total_cost = total_cost + ? WHERE username = ?",
+                             [(entry[4], entry[0]) for entry in entries])
+    except sqlite3.Error as e:
+        print(f"Error writing usage records: {e}")
+        with _pending_lock:
+            _pending_usage[:0] = entries
+
+
+atexit.register(flush_usage)
+
+
+def update_user_cost(username, cost, model=None, prompt_tokens=0, completion_tokens=0):
+    """Record the cost of one call; records reach the database in batches"""
+    with _pending_lock:
+        _pending_usage.append((username, model, prompt_tokens, completion_tokens, cost, time.time()))
+        due = len(_pending_usage) >= LEDGER_FLUSH_SIZE or time.time() - _last_flush >= LEDGER_FLUSH_SECONDS
+    if due:
+        flush_usage()
+
+def record_usage(username, model, prompt_tokens=0, completion_tokens=0, cached_tokens=0, images=0):
+    """Price the usage a call reported with the model registry and record it; returns the cost"""
+    cost = usage_cost(model, prompt_tokens, completion_tokens, cached_tokens, images)
+    update_user_cost(username, cost, model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    return cost
+
+def get_user_cost(username, month=None):
+    """Cost of a user in a month (default: the current one), including records not flushed yet"""
+    month = month or _month(time.time())
+    with _connect() as conn:
+        result = conn.execute(
+            "SELECT cost FROM monthly_costs WHERE username = ? AND month = ?", (username, month)
+        ).fetchone()
+    with _pending_lock:
+        pending = sum(entry[4] for entry in _pending_usage if entry[0] == username and _month(entry[5]) == month)
+    return (result[0] if result else 0.0) + pending
 
 # verify existing user
-def verify_user(username, password):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
+def verify_user(username, password, ip=None):
+    """
+    Check a password on the hashing pool. Raises LoginRateLimited when the username or client IP
+    had too many recent failures. Hashes with an outdated work factor are replaced on success.
+    """
+    _check_login_rate(username, ip)
     fetch_pwd = "SELECT password FROM users WHERE username = ?"
-    c.execute(fetch_pwd, (username,))
-    result = c.fetchone()
-    conn.close()
+    with _connect() as conn:
+        result = conn.execute(fetch_pwd, (username,)).fetchone()
 
-    if result:
-        stored_hashed_password = result[0]
-        return bcrypt.checkpw(password.encode('utf-8'), stored_hashed_password)  
+    if result and _check_password(password, result[0]):
+        with _failures_lock:
+            _failures.pop(("user", username), None)
+        if _hash_rounds(result[0]) != BCRYPT_ROUNDS:
+            new_hash = _hash_password(password)
+            with _connect() as conn, conn:
+                conn.execute("UPDATE users SET password = ? WHERE username = ?", (new_hash, username))
+        return True
+    _record_login_failure(username, ip)
     return False
+
+# Verified sessions: reruns check the token instead of hashing the password again
+def create_session(username):
+    global _last_session_sweep
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    with _sessions_lock:
+        if now - _last_session_sweep >= SWEEP_INTERVAL_SECONDS:
+            # Sessions that are never presented again would otherwise stay forever
+            for expired in [key for key, (_, expires_at) in _sessions.items() if expires_at < now]:
+                del _sessions[expired]
+            _last_session_sweep = now
+        _sessions[token] = (username, now + SESSION_TTL_SECONDS)
+    return token
+
+def get_session_user(token):
+    """Username of a live session token (its expiry slides forward on use), or None"""
+    if not token:
+        return None
+    now = time.time()
+    with _sessions_lock:
+        session = _sessions.get(token)
+        if session is None or session[1] < now:
+            _sessions.pop(token, None)
+            return None
+        _sessions[token] = (session[0], now + SESSION_TTL_SECONDS)
+        return session[0]
+
+def end_session(token):
+    with _sessions_lock:
+        _sessions.pop(token, None)
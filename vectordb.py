@@ -3,120 +3,601 @@ import streamlit as st
 import chromadb
 from chromadb.utils.embedding_functions.openai_embedding_function import OpenAIEmbeddingFunction
 from langchain_core.documents import Document
-import os
+from embeddingcache import CachedEmbeddingFunction
+from lexicalindex import get_lexical_index, close_lexical_index
+from tokenizer import count_tokens
+from openai import RateLimitError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, FIRST_COMPLETED, wait
+import contextlib, os, threading, time, hashlib, json, random
+import numpy as np
 
 
-# Create the vector collection: import chromadb
-def get_vector_collection(api_key: str, store_path: str, collection_name: str) -> chromadb.Collection:
-    openai_ef = OpenAIEmbeddingFunction(
-        api_key=api_key, model_name="text-embedding-3-small"
-    )
-    try:
-        # embedding_function = create_cached_embedding_function(api_key)
-        chroma_client = chromadb.PersistentClient(path=store_path)
-        collection = chroma_client.get_or_create_collection(
-            name=collection_name,
-            embedding_function=openai_ef,
-            metadata={"hnsw:space": "cosine"}
-        )
-        return collection
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAIN_STORE_PATH = "rag-chroma-main"
+MAIN_COLLECTION_NAME = "sca-rag-pilot-main"
+TEMP_STORE_PREFIX = "rag_chroma_temp_"
+
+# Registry limits: warm collections kept across reruns and sessions, idle temp stores closed after a while
+MAX_OPEN_COLLECTIONS = 32
+TEMP_STORE_IDLE_SECONDS = 30 * 60
+# Threads used to query collections concurrently
+QUERY_MAX_WORKERS = 4
+# Retrieval tuning: candidates fetched per result, relevance/diversity trade-off and context size
+MMR_FETCH_MULTIPLIER = 3
+MMR_LAMBDA = 0.5
+CONTEXT_TOKEN_BUDGET = 3000
+# Reciprocal-rank fusion constant for combining vector and BM25 rankings
+RRF_K = 60
+# Chunks read from chroma per request when indexing a store that predates its BM25 index
+LEXICAL_BACKFILL_BATCH_SIZE = 1000
+# Embedding batches: packed by tokens below the API request limits, a bounded number in flight,
+# exponential backoff on rate limits
+EMBED_BATCH_MAX_TOKENS = 100_000
+EMBED_BATCH_MAX_INPUTS = 2048
+EMBED_MAX_IN_FLIGHT = 4
+EMBED_MAX_RETRIES = 6
+EMBED_BACKOFF_SECONDS = 1.0
+
+# Process-wide registry of chroma clients and collections, shared by every Streamlit session
+_registry_lock = threading.RLock()
+_clients: dict = {}                     # store_path -> chromadb client
+_collections: OrderedDict = OrderedDict()   # (store_path, collection_name) -> collection, in LRU order
+_last_used: dict = {}                   # (store_path, collection_name) -> time.monotonic() of last access
+_leases: dict = {}                      # (store_path, collection_name) -> number of callers using the collection
+_embedding_functions: dict = {}         # (api_key, model_name) -> embedding function
+_manifest_lock = threading.Lock()
+_backfilled: set = set()                # (store_path, collection_name) whose BM25 index covers the whole collection
+_backfill_lock = threading.Lock()
+_query_pool = ThreadPoolExecutor(max_workers=QUERY_MAX_WORKERS, thread_name_prefix="vectordb-query")
+# Shared by all ingestions, so concurrent uploads together stay within EMBED_MAX_IN_FLIGHT requests
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_MAX_IN_FLIGHT, thread_name_prefix="vectordb-embed")
 
+
+def get_temp_store(username: str, chat_id: str) -> tuple[str, str]:
+    """Return (store_path, collection_name) of the per-chat temporary vector store."""
+    return f"{TEMP_STORE_PREFIX}{username}_{chat_id}", f"sca_rag_temp_{username}_{chat_id}"
+
+
+def get_embedding_function(api_key: str, model_name: str = EMBEDDING_MODEL) -> CachedEmbeddingFunction:
+    """Return the shared, cache-backed embedding function for the given key and model."""
+    with _registry_lock:
+        key = (api_key, model_name)
+        if key not in _embedding_functions:
+            openai_ef = OpenAIEmbeddingFunction(api_key=api_key, model_name=model_name)
+            _embedding_functions[key] = CachedEmbeddingFunction(openai_ef, model_name)
+        return _embedding_functions[key]
+
+
+def _release_client(store_path: str):
+    """Stop the chroma system behind a client and close the store's BM25 index, so their SQLite handles are freed."""
+    close_lexical_index(store_path)
+    client = _clients.pop(store_path, None)
+    if client is None:
+        return
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+        client._system.stop()
+        SharedSystemClient._identifier_to_system.pop(client._identifier, None)
     except Exception as e:
-        st.error(f"ChromaDB connection test failed: {e}")
-        raise e
+        print(f"Error closing vector store {store_path}: {e}")
 
 
-# Add to vector collection
-def add_to_collection(all_splits: list[Document], file_name: str, file_size_bytes: float, api_key: str, store_path: str, collection_name: str):  
+def _store_in_use(store_path: str) -> bool:
+    """True while a collection of the store is pooled or leased."""
+    return any(path == store_path for path, _ in _collections) or any(path == store_path for path, _ in _leases)
+
+
+def _drop_collection(key: tuple[str, str]):
+    """Remove a collection from the registry, closing its client when no collection uses it anymore."""
+    _collections.pop(key, None)
+    _last_used.pop(key, None)
+    store_path = key[0]
+    if not _store_in_use(store_path):
+        _release_client(store_path)
+
+
+def _close_idle_temp_stores(now: float):
+    idle = [key for key, last_used in _last_used.items()
+            if os.path.basename(key[0]).startswith(TEMP_STORE_PREFIX) and now - last_used > TEMP_STORE_IDLE_SECONDS
+            and key not in _leases]
+    for key in idle:
+        _drop_collection(key)
+
+
+def close_vector_store(store_path: str):
     """
-    Add document splits to vector collection.
-    
-    Args:
-        all_splits: List of Document objects to add
-        file_name: Name of the file being processed
-        file_size_bytes: Size of the file in bytes
-        api_key: OpenAI API key for embeddings
-        store_path: Path to store the vector collection
-        collection_name: Name of the collection
+    Close every pooled collection and the client of a vector store.
+    Must be called before the store directory is removed from disk.
+    A store that is still leased is closed when its last lease is returned.
     """
-    if not all_splits:
-        st.warning("No content to add to vector store.")
-        return
-        
-    collection = get_vector_collection(api_key, store_path, collection_name)
-    num_splits = len(all_splits)
-    kb_500 = 500 * 1024
-    num_batches = max(1, (file_size_bytes + kb_500 - 1) // kb_500)
-    dynamic_batch_size = num_splits // num_batches if num_batches > 0 else num_splits 
-
-    for i in range(0, num_splits, dynamic_batch_size):
-        batch_splits = all_splits[i:i + dynamic_batch_size]
-        # Extract content and metadata from Document objects
-        batch_documents = [split.page_content for split in batch_splits]
-        batch_metadatas = [split.metadata for split in batch_splits]
-        batch_ids = [f"{file_name}_{idx}" for idx in range(i, i + len(batch_splits))]
-        batch_num = i // dynamic_batch_size + 1
+    store_path = os.path.abspath(store_path)
+    with _registry_lock:
+        for key in [key for key in _collections if key[0] == store_path]:
+            _drop_collection(key)
+        _backfilled.difference_update([key for key in _backfilled if key[0] == store_path])
+        if _store_in_use(store_path):
+            print(f"Vector store {store_path} is still in use, closing it once the last caller is done.")
+            return
+        _release_client(store_path)
+
+
+# Create the vector collection: import chromadb
+def get_vector_collection(api_key: str, store_path: str, collection_name: str) -> chromadb.Collection:
+    """
+    Return a pooled collection for (store_path, collection_name).
+    Clients and collections are created once per process and reused across reruns and sessions.
+    """
+    key = (os.path.abspath(store_path), collection_name)
+    with _registry_lock:
+        now = time.monotonic()
+        _close_idle_temp_stores(now)
+        if key in _collections:
+            _collections.move_to_end(key)
+            _last_used[key] = now
+            return _collections[key]
 
         try:
-            collection.upsert(
-                documents=batch_documents,
-                metadatas=batch_metadatas,
-                ids=batch_ids,
+            chroma_client = _clients.get(key[0])
+            if chroma_client is None:
+                chroma_client = chromadb.PersistentClient(path=key[0])
+                _clients[key[0]] = chroma_client
+            collection = chroma_client.get_or_create_collection(
+                name=collection_name,
+                embedding_function=get_embedding_function(api_key),
+                metadata={"hnsw:space": "cosine"}
             )
-            print(f"Batch {batch_num}/{(num_splits + dynamic_batch_size - 1) // dynamic_batch_size} added successfully.")
         except Exception as e:
-            st.error(f"Error upserting batch {batch_num}: {e}")
+            st.error(f"ChromaDB connection test failed: {e}")
+            raise e
+
+        _collections[key] = collection
+        _last_used[key] = now
+        if key not in _backfilled and collection.count() == 0:
+            # A new (or emptied) collection has nothing to backfill: every chunk is indexed as it is written
+            get_lexical_index(key[0]).mark_backfilled(collection_name)
+            _backfilled.add(key)
+        # Evict the least recently used collections over the limit; leased collections are skipped
+        evictable = [other for other in _collections if other not in _leases and other != key]
+        for other in evictable[:len(_collections) - MAX_OPEN_COLLECTIONS]:
+            _drop_collection(other)
+        return collection
+
+
+@contextlib.contextmanager
+def lease_collection(api_key: str, store_path: str, collection_name: str):
+    """
+    Pooled collection held for the duration of a with block.
+    A leased collection is never evicted, and its client is only stopped once every lease is returned.
+    """
+    key = (os.path.abspath(store_path), collection_name)
+    with _registry_lock:
+        collection = get_vector_collection(api_key, store_path, collection_name)
+        _leases[key] = _leases.get(key, 0) + 1
+    try:
+        yield collection
+    finally:
+        with _registry_lock:
+            _leases[key] -= 1
+            if not _leases[key]:
+                del _leases[key]
+                if not _store_in_use(key[0]):
+                    # The collection was dropped while leased (close_vector_store): finish closing its store
+                    _release_client(key[0])
+
+
+def chunk_id(file_name: str, text: str) -> str:
+    """Stable chunk id derived from the chunk content, so unchanged chunks keep their id across re-uploads."""
+    return f"{file_name}_{hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]}"
+
+
+def _manifest_path(store_path: str, collection_name: str) -> str:
+    return os.path.join(store_path, f"{collection_name}_manifest.json")
+
+
+def load_manifest(store_path: str, collection_name: str) -> dict:
+    """Per-collection manifest: file name -> {"file_hash": ..., "chunk_ids": [...]}"""
+    path = _manifest_path(store_path, collection_name)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
+def _record_manifest(store_path: str, collection_name: str, file_name: str, file_hash, chunk_ids, members: dict = None):
+    with _manifest_lock:
+        manifest = load_manifest(store_path, collection_name)
+        manifest[file_name] = {"file_hash": file_hash, "chunk_ids": sorted(chunk_ids)}
+        if members:
+            manifest[file_name]["members"] = members
+        os.makedirs(store_path, exist_ok=True)
+        path = _manifest_path(store_path, collection_name)
+        # Write to a side file and swap it in, so a crash never leaves a truncated manifest
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+
+def get_indexed_members(store_path: str, collection_name: str, file_name: str) -> dict:
+    """Archive member name -> content hash of the members indexed for an archive."""
+    members = load_manifest(store_path, collection_name).get(file_name, {}).get("members", {})
+    return {name: member["hash"] for name, member in members.items()}
+
+
+def is_file_indexed(store_path: str, collection_name: str, file_name: str, file_hash: str) -> bool:
+    """True when this exact file content is already in the collection."""
+    entry = load_manifest(store_path, collection_name).get(file_name)
+    return bool(file_hash) and entry is not None and entry.get("file_hash") == file_hash
+
+
+def _split_tokens(split: Document) -> int:
+    return split.metadata.get("token_count") or count_tokens(split.page_content)
+
+
+def _embed_with_retry(embedding_function, texts: list[str]):
+    """Embed one batch, backing off exponentially (with jitter) when the API rate-limits it."""
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            return embedding_function(texts)
+        except RateLimitError as e:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            retry_after = e.response.headers.get("retry-after") if getattr(e, "response", None) is not None else None
+            delay = float(retry_after) if retry_after else EMBED_BACKOFF_SECONDS * 2 ** attempt
+            delay += random.uniform(0, EMBED_BACKOFF_SECONDS)
+            print(f"Embedding rate-limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{EMBED_MAX_RETRIES}).")
+            time.sleep(delay)
+
+
+class _EmbeddingWindow:
+    """
+    Embeds and upserts the chunks of one ingestion through a single window of EMBED_MAX_IN_FLIGHT requests.
+    Chunks are packed by tokens across the batches handed in, up to EMBED_BATCH_MAX_TOKENS and EMBED_BATCH_MAX_INPUTS
+    per request. A partial pack is only sent when no request is in flight, so the API is never idle while chunks wait.
+    """
+    def __init__(self, collection, api_key: str, store_path: str, collection_name: str):
+        self.collection = collection
+        self.store_path = store_path
+        self.collection_name = collection_name
+        self._embedding_function = get_embedding_function(api_key)
+        self._splits, self._ids, self._tokens = [], [], 0
+        self._pending = {}   # future -> (splits, ids) of the requests in flight
+        self._batch_num = 0
+        self.upserted_ids = set()   # ids actually written to chroma and the BM25 index
+
+    def add(self, splits: list[Document], ids: list[str]):
+        for split, split_id in zip(splits, ids):
+            tokens = _split_tokens(split)
+            if self._splits and (self._tokens + tokens > EMBED_BATCH_MAX_TOKENS or len(self._splits) >= EMBED_BATCH_MAX_INPUTS):
+                self._submit()
+            self._splits.append(split)
+            self._ids.append(split_id)
+            self._tokens += tokens
+        self._collect(block=False)
+        if self._splits and not self._pending:
+            self._submit()
+
+    def flush(self):
+        """Send the last partial pack and wait until every chunk is upserted"""
+        if self._splits:
+            self._submit()
+        while self._pending:
+            self._collect(block=True)
+
+    def cancel(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+    def _submit(self):
+        while len(self._pending) >= EMBED_MAX_IN_FLIGHT:
+            self._collect(block=True)
+        documents = [split.page_content for split in self._splits]
+        future = _embed_pool.submit(_embed_with_retry, self._embedding_function, documents)
+        self._pending[future] = (self._splits, self._ids)
+        self._splits, self._ids, self._tokens = [], [], 0
+
+    def _collect(self, block: bool):
+        """Upsert the packs whose embeddings arrived; with block, wait for at least one"""
+        if not self._pending:
+            return
+        done, _ = wait(self._pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch_splits, batch_ids = self._pending.pop(future)
+            batch_documents = [split.page_content for split in batch_splits]
+            self._batch_num += 1
+            try:
+                self.collection.upsert(
+                    documents=batch_documents,
+                    metadatas=[split.metadata for split in batch_splits],
+                    embeddings=future.result(),
+                    ids=batch_ids,
+                )
+                # Keep the BM25 index of the store in step with chroma
+                get_lexical_index(self.store_path).add(self.collection_name, batch_ids, batch_documents)
+                self.upserted_ids.update(batch_ids)
+                print(f"Batch {self._batch_num} ({len(batch_ids)} chunks) added successfully.")
+            except Exception as e:
+                st.error(f"Error upserting batch {self._batch_num}: {e}")
+                raise
+
+
+def _new_splits(splits: list[Document], file_name: str, known_ids: set) -> tuple[list[Document], list[str], list[str]]:
+    """Return (new splits, their ids, ids of all splits); known ids and duplicates within the file are skipped."""
+    all_ids, new_splits, new_ids = [], [], []
+    for split in splits:
+        split_id = chunk_id(file_name, split.page_content)
+        all_ids.append(split_id)
+        if split_id not in known_ids:
+            known_ids.add(split_id)
+            new_splits.append(split)
+            new_ids.append(split_id)
+    return new_splits, new_ids, all_ids
+
+
+def _remove_chunks(collection, store_path: str, collection_name: str, stale_ids: set):
+    if stale_ids:
+        stale_ids = sorted(stale_ids)
+        collection.delete(ids=stale_ids)
+        get_lexical_index(store_path).delete(collection_name, stale_ids)
+        print(f"Removed {len(stale_ids)} stale chunks.")
+
+
+def add_batches_to_collection(split_batches, file_name: str, api_key: str, store_path: str, collection_name: str,
+                              file_hash: str = None, unchanged_members: set = None) -> int:
+    """
+    Add batches of splits to the vector collection as they are produced (e.g. by fileprocessing.iter_document_batches),
+    so early chunks become searchable while the rest of the file is still being extracted.
+    Stale chunks of a previous version are only deleted once the whole file went through.
+    For archives, chunks are tracked per member (archive_member metadata); the chunks of members listed in
+    unchanged_members (filled while the batches are produced) are kept as they are.
+
+    Returns:
+        The number of chunks of the file now in the collection (0 when the file was skipped as unchanged)
+    """
+    if is_file_indexed(store_path, collection_name, file_name, file_hash):
+        print(f"{file_name} is unchanged, skipping.")
+        return 0
+
+    with lease_collection(api_key, store_path, collection_name) as collection:
+        previous_ids = set(load_manifest(store_path, collection_name).get(file_name, {}).get("chunk_ids", []))
+        known_ids = set(previous_ids)
+        seen_ids = set()
+        members = {}
+        # One embedding window for the whole file, so packs span the extracted batches
+        window = _EmbeddingWindow(collection, api_key, store_path, collection_name)
+        try:
+            for batch in split_batches:
+                new_splits, new_ids, all_ids = _new_splits(batch, file_name, known_ids)
+                window.add(new_splits, new_ids)
+                seen_ids.update(all_ids)
+                for split, split_id in zip(batch, all_ids):
+                    if "archive_member" in split.metadata:
+                        member = members.setdefault(split.metadata["archive_member"],
+                                                    {"hash": split.metadata["member_hash"], "chunk_ids": []})
+                        member["chunk_ids"].append(split_id)
+            window.flush()
+        except Exception:
+            window.cancel()
+            # Keep track of what was written so a retry can clean it up, but do not treat the file as complete.
+            # Only upserted chunks are recorded: a retry skips recorded ids, so chunks still packed or in flight must stay out
+            _record_manifest(store_path, collection_name, file_name, None, previous_ids | window.upserted_ids)
             raise
 
+        # Unchanged archive members were skipped: keep their chunks
+        previous_members = load_manifest(store_path, collection_name).get(file_name, {}).get("members", {})
+        for member_name in unchanged_members or ():
+            if member_name in previous_members:
+                members[member_name] = previous_members[member_name]
+                seen_ids.update(previous_members[member_name]["chunk_ids"])
+
+        if seen_ids:
+            _remove_chunks(collection, store_path, collection_name, previous_ids - seen_ids)
+            _record_manifest(store_path, collection_name, file_name, file_hash, seen_ids, members)
+
+    cache_stats = get_embedding_function(api_key).stats()
+    print(f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.")
+    return len(seen_ids)
+
+
+def _backfill_lexical_index(collection, store_path: str, collection_name: str):
+    """Add the chunks stored before the BM25 index existed to it; runs once per collection."""
+    key = (os.path.abspath(store_path), collection_name)
+    if key in _backfilled:
+        return
+    with _backfill_lock:
+        if key in _backfilled:
+            return
+        index = get_lexical_index(store_path)
+        if not index.is_backfilled(collection_name):
+            offset = 0
+            while True:
+                batch = collection.get(include=["documents"], limit=LEXICAL_BACKFILL_BATCH_SIZE, offset=offset)
+                if not batch["ids"]:
+                    break
+                index.add(collection_name, batch["ids"], [document or "" for document in batch["documents"]])
+                offset += len(batch["ids"])
+            index.mark_backfilled(collection_name)
+            print(f"BM25 index of {collection_name}: backfilled {offset} existing chunks.")
+        _backfilled.add(key)
+
+
+def _query_targets() -> list[tuple[str, str]]:
+    """Collections searched for the current session: the main store, plus the chat's temp store for non-admin users."""
+    targets = [(MAIN_STORE_PATH, MAIN_COLLECTION_NAME)]
+    username = st.session_state.get("username")
+    if username != "admin" and "current_chat_id" in st.session_state:
+        store_path, collection_name = get_temp_store(username, st.session_state.current_chat_id)
+        # Check if the temporary collection exists before querying
+        if os.path.exists(store_path):
+            targets.append((store_path, collection_name))
+    return targets
+
+
+def _cosine_distance(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    return float(1 - a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def _query_one(api_key: str, prompt: str, store_path: str, collection_name: str, query_embedding, n_results: int) -> list[dict]:
+    """
+    Query a single collection with a precomputed embedding and with its BM25 index.
+    Returns one hit per result; "bm25" is 0.0 for hits that only the vector search found.
+    """
+    with lease_collection(api_key, store_path, collection_name) as collection:
+        results = collection.query(
+            query_embeddings=[query_embedding], n_results=n_results,
+            include=["documents", "metadatas", "distances", "embeddings"]
+        )
+        hits = {
+            doc_id: {"id": doc_id, "document": document, "metadata": metadata or {}, "distance": distance,
+                     "embedding": embedding, "collection": collection_name, "bm25": 0.0}
+            for doc_id, document, metadata, distance, embedding in zip(
+                results["ids"][0], results["documents"][0], results["metadatas"][0],
+                results["distances"][0], results["embeddings"][0]
+            )
+        }
+
+        # Lexical matches missed by the vector search are fetched from chroma, no embedding call needed
+        _backfill_lexical_index(collection, store_path, collection_name)
+        lexical = get_lexical_index(store_path).search(collection_name, prompt, n_results)
+        missing = [doc_id for doc_id, _ in lexical if doc_id not in hits]
+        if missing:
+            fetched = collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+            for doc_id, document, metadata, embedding in zip(
+                fetched["ids"], fetched["documents"], fetched["metadatas"], fetched["embeddings"]
+            ):
+                hits[doc_id] = {"id": doc_id, "document": document, "metadata": metadata or {},
+                                "distance": _cosine_distance(query_embedding, embedding),
+                                "embedding": embedding, "collection": collection_name, "bm25": 0.0}
+        for doc_id, score in lexical:
+            if doc_id in hits:
+                hits[doc_id]["bm25"] = score
+        return list(hits.values())
+
+
+def _fuse_ranks(hits: list[dict]) -> list[float]:
+    """Reciprocal-rank fusion of the vector ranking (by distance) and the BM25 ranking."""
+    scores = [0.0] * len(hits)
+    vector_order = sorted(range(len(hits)), key=lambda i: hits[i]["distance"])
+    lexical_order = sorted((i for i in range(len(hits)) if hits[i]["bm25"] > 0), key=lambda i: -hits[i]["bm25"])
+    for order in (vector_order, lexical_order):
+        for rank, i in enumerate(order):
+            scores[i] += 1.0 / (RRF_K + rank + 1)
+    return scores
+
+
+def mmr_select(query_embedding, embeddings, k: int, lambda_mult: float = MMR_LAMBDA, relevance=None) -> list[int]:
+    """
+    Maximal marginal relevance over candidate embeddings.
+    Returns the indices of up to k candidates, balancing similarity to the query against similarity to those already picked.
+    A precomputed relevance score per candidate (e.g. a fused rank score) replaces the cosine similarity to the query.
+    """
+    if len(embeddings) == 0 or k <= 0:
+        return []
+    candidates = np.array(embeddings, dtype=np.float32)
+    candidates /= np.linalg.norm(candidates, axis=1, keepdims=True) + 1e-12
+    query = np.array(query_embedding, dtype=np.float32)
+    query /= np.linalg.norm(query) + 1e-12
+
+    if relevance is None:
+        relevance = candidates @ query
+    else:
+        relevance = np.asarray(relevance, dtype=np.float32)
+        relevance = relevance / (relevance.max() + 1e-12)
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return selected
+
+
+def _hit_tokens(hit: dict) -> int:
+    """Token size of a hit: the count stored at ingestion when present, otherwise a character-based estimate."""
+    token_count = hit["metadata"].get("token_count")
+    return int(token_count) if token_count else len(hit["document"]) // 4 + 1
+
+
+def _fit_token_budget(hits: list[dict], max_context_tokens: int) -> list[dict]:
+    """Keep hits in order while they fit in the token budget; the first hit is always kept."""
+    kept, used = [], 0
+    for hit in hits:
+        tokens = _hit_tokens(hit)
+        if kept and used + tokens > max_context_tokens:
+            continue
+        kept.append(hit)
+        used += tokens
+    return kept
 
 
 # Query the vector collection: semantic search algorithm
-def query_collection(prompt: str, api_key: str, n_results=10):
-    # First, try to get results from the main collection
+def query_collection(prompt: str, api_key: str, n_results=10, max_context_tokens: int = CONTEXT_TOKEN_BUDGET,
+                     lambda_mult: float = MMR_LAMBDA):
+    """
+    Search the main collection and the chat's temp collection in parallel.
+    The prompt is embedded once, vector and BM25 candidates from all collections are combined with
+    reciprocal-rank fusion, diversified with MMR and trimmed to the token budget.
+
+    Args:
+        prompt: The user query
+        api_key: OpenAI API key for embeddings
+        n_results: Maximum number of documents returned
+        max_context_tokens: Token budget of the returned documents
+        lambda_mult: MMR trade-off, 1.0 is pure relevance and 0.0 pure diversity
+
+    Returns:
+        A dict with "documents", "distances", "metadatas" and "ids", each a single-element list (chroma layout)
+    """
+    targets = _query_targets()
     try:
-        main_collection = get_vector_collection(api_key, store_path="rag-chroma-main", collection_name="sca-rag-pilot-main")
-        main_results = main_collection.query(query_texts=[prompt], n_results=n_results)
-        main_docs = main_results.get("documents", [[]])[0]
+        query_embedding = get_embedding_function(api_key)([prompt])[0]
     except Exception as e:
-        st.warning(f"Error querying main collection: {e}")
-        main_docs = []
-    
-    # For non-admin users, also query their temporary collection
-    if st.session_state.get("username") != "admin":
+        st.warning(f"Error embedding the query: {e}")
+        return {"documents": [["No relevant information found in the knowledge base."]]}
+
+    # Fan out to every collection; total latency is that of the slowest one
+    futures = {
+        _query_pool.submit(_query_one, api_key, prompt, store_path, collection_name, query_embedding,
+                           n_results * MMR_FETCH_MULTIPLIER): collection_name
+        for store_path, collection_name in targets
+    }
+    hits = []
+    for future in as_completed(futures):
         try:
-            username = st.session_state.get("username")
-            chat_id = st.session_state.current_chat_id
-            store_path = f"rag_chroma_temp_{username}_{chat_id}"
-            collection_name = f"sca_rag_temp_{username}_{chat_id}"
-            
-            # Check if the temporary collection exists before querying
-            if os.path.exists(store_path):
-                temp_collection = get_vector_collection(api_key, store_path=store_path, collection_name=collection_name)
-                temp_results = temp_collection.query(query_texts=[prompt], n_results=n_results)
-                temp_docs = temp_results.get("documents", [[]])[0]
-            else:
-                temp_docs = []
+            hits.extend(future.result())
         except Exception as e:
-            st.warning(f"Error querying temporary collection: {e}")
-            temp_docs = []
-        
-        # Combine documents from both collections
-        combined_docs = main_docs + temp_docs
-    else:
-        combined_docs = main_docs
-    
-    # Calculate relevance scores and sort by most relevant
-    if combined_docs:
-        # Filter out empty documents and deduplicate
-        filtered_docs = []
-        seen_content = set()
-        for doc in combined_docs:
-            doc_content = doc.strip()
-            if doc_content and doc_content not in seen_content:
-                filtered_docs.append(doc_content)
-                seen_content.add(doc_content)
-        
-        combined_results = {"documents": [filtered_docs]}
-        return combined_results
+            st.warning(f"Error querying collection {futures[future]}: {e}")
+
+    # Merge by fused rank, filter out empty documents and deduplicate
+    for hit, score in zip(hits, _fuse_ranks(hits)):
+        hit["score"] = score
+    merged = []
+    seen_content = set()
+    for hit in sorted(hits, key=lambda hit: -hit["score"]):
+        doc_content = (hit["document"] or "").strip()
+        if doc_content and doc_content not in seen_content:
+            merged.append({**hit, "document": doc_content})
+            seen_content.add(doc_content)
+
+    # Drop near-duplicate overlapping chunks, then respect the token budget (MMR order is kept)
+    selected = mmr_select(query_embedding, [hit["embedding"] for hit in merged], n_results, lambda_mult,
+                          relevance=[hit["score"] for hit in merged])
+    merged = _fit_token_budget([merged[i] for i in selected], max_context_tokens)
+
+    if merged:
+        return {
+            "documents": [[hit["document"] for hit in merged]],
+            "distances": [[hit["distance"] for hit in merged]],
+            "metadatas": [[hit["metadata"] for hit in merged]],
+            "ids": [[hit["id"] for hit in merged]],
+        }
     else:
-        return {"documents": [["No relevant information found in the knowledge base."]]}
\ No newline at end of file
+        return {"documents": [["No relevant information found in the knowledge base."]]}